@@ -3,18 +3,41 @@
 """Python versions hooks."""
 
 import argparse
+import concurrent.futures
+import contextlib
+import dataclasses
+import difflib
+import fnmatch
+import functools
+import io
+import json
+import os
 import pkgutil
+import random
 import re
 import subprocess
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterator
 from pathlib import Path
-from typing import Any
+from typing import Any, TypeVar
 
 import multi_repo_automation as mra
+import multi_repo_automation.tools
 import packaging.requirements
 import packaging.specifiers
 import packaging.version
 import requests
+import ruamel.yaml
 import tomlkit
+import tomlkit.exceptions
+import tomlkit.items
+
+if sys.version_info >= (3, 11):
+    import tomllib
+if sys.platform != "win32":
+    import fcntl
 
 
 def _filenames(pattern: str) -> list[Path]:
@@ -36,11 +59,43 @@ def _natural_sort_key(text: str) -> list[int | str]:
     return [int(value) if value.isdigit() else value.lower() for value in _digit.split(text)]
 
 
+# The files locked by the current thread
+_LOCKED_FILES = threading.local()
+
+
+@contextlib.contextmanager
+def _lock_files(paths: list[Path], shared_paths: list[Path] | None = None) -> Iterator[None]:
+    """
+    Take advisory locks on existing files, to be safe with the other running processes.
+
+    The `paths` are locked exclusively, the `shared_paths` with a shared lock. The locks are taken
+    in a stable order to avoid the deadlocks, and the files already locked by the current thread
+    are skipped.
+    """
+    locked: set[Path] = _LOCKED_FILES.__dict__.setdefault("paths", set())
+    exclusive = {path.resolve() for path in paths if path.exists()}
+    shared = {path.resolve() for path in shared_paths or [] if path.exists()} - exclusive
+    with contextlib.ExitStack() as stack:
+        for path in sorted((exclusive | shared) - locked):
+            file = stack.enter_context(path.open("rb"))
+            if sys.platform != "win32":
+                fcntl.flock(file, fcntl.LOCK_SH if path in shared else fcntl.LOCK_EX)
+            locked.add(path)
+            stack.callback(locked.discard, path)
+        yield
+
+
+def _read_text(path: Path) -> str:
+    """Read a file that can be updated by another process."""
+    with _lock_files([], [path]):
+        return path.read_text(encoding="utf-8")
+
+
 def _get_python_version_from_file(directory: Path) -> packaging.version.Version | None:
     """Read Python version from .python-version file in a directory."""
     python_version_path = directory / ".python-version"
     if python_version_path.exists():
-        raw = python_version_path.read_text().strip()
+        raw = _read_text(python_version_path).strip()
         try:
             return packaging.version.parse(raw)
         except packaging.version.InvalidVersion:
@@ -51,6 +106,7 @@ def _get_python_version_from_file(directory: Path) -> packaging.version.Version
 
 def _detect_python_version(
     directory: Path,
+    root: Path | None = None,
 ) -> packaging.specifiers.SpecifierSet | packaging.version.Version | None:
     """
     Detect Python version for a directory.
@@ -58,7 +114,7 @@ def _detect_python_version(
     With priority:
     1. pyproject.toml (local)
     2. .python-version (local)
-    3. Parent directory (recursive)
+    3. Parent directory (recursive), up to the root
     """
     # 1. Check pyproject.toml
     pyproject_path = directory / "pyproject.toml"
@@ -74,8 +130,8 @@ def _detect_python_version(
 
     # 3. Recursively check parent directory
     parent = directory.parent
-    if parent != directory:  # Avoid infinite loop at root
-        return _detect_python_version(parent)
+    if directory not in (parent, root):  # Avoid infinite loop at root
+        return _detect_python_version(parent, root)
 
     return None  # No version found
 
@@ -92,13 +148,19 @@ def _get_python_version(
 
     # Fallback to embedded .python-version if not found in directory
     if last_version is None:
-        data = pkgutil.get_data("python_versions_hook", ".python-version")
-        assert data is not None
-        last_version = packaging.version.parse(data.decode("utf-8").strip())
+        last_version = _get_embedded_python_version()
 
     return first_version, last_version
 
 
+@functools.cache
+def _get_embedded_python_version() -> packaging.version.Version:
+    """Get the last known Python version, from the embedded .python-version."""
+    data = pkgutil.get_data("python_versions_hook", ".python-version")
+    assert data is not None
+    return packaging.version.parse(data.decode("utf-8").strip())
+
+
 def _convert_poetry_version_to_specifier(version: str) -> str:
     """Convert Poetry version syntax (^3.8) to PEP 440 specifiers (>=3.8,<4.0)."""
     if version.startswith("^"):
@@ -115,170 +177,728 @@ def _normalize_specifier_set(specifier_set: packaging.specifiers.SpecifierSet) -
 
 
 def _get_python_specifiers_version(pyproject_path: Path) -> packaging.specifiers.SpecifierSet | None:
-    with mra.EditTOML(pyproject_path) as pyproject:
-        config = pyproject.get("tool", {}).get("python-versions-hook", {})
-        keep_requires_python = config.get("keep-requires-python", False)
-        use_requires_python = keep_requires_python and "requires-python" in pyproject.get("project", {})
+    return _get_python_specifiers_version_from_config(_load_toml(_read_text(pyproject_path)))
 
-        if not use_requires_python and "python" in pyproject.get("tool", {}).get("poetry", {}).get(
-            "dependencies",
-            {},
+
+def _get_python_specifiers_version_from_config(
+    pyproject: dict[str, Any] | mra.EditTOML,
+) -> packaging.specifiers.SpecifierSet | None:
+    config = pyproject.get("tool", {}).get("python-versions-hook", {})
+    keep_requires_python = config.get("keep-requires-python", False)
+    use_requires_python = keep_requires_python and "requires-python" in pyproject.get("project", {})
+
+    if not use_requires_python and "python" in pyproject.get("tool", {}).get("poetry", {}).get(
+        "dependencies",
+        {},
+    ):
+        version = pyproject["tool"]["poetry"]["dependencies"]["python"]
+        version = _convert_poetry_version_to_specifier(version)
+        specifier_set = packaging.specifiers.SpecifierSet(version)
+        # Normalize the order of specifiers
+        normalized_version = ",".join(sorted(str(s) for s in specifier_set))
+        return packaging.specifiers.SpecifierSet(normalized_version)
+
+    if "requires-python" in pyproject.get("project", {}):
+        return packaging.specifiers.SpecifierSet(
+            pyproject["project"]["requires-python"],
+        )
+    return None
+
+
+def _get_root_config(root: Path) -> dict[str, Any]:
+    """Get the `[tool.python-versions-hook]` configuration from the root pyproject.toml."""
+    pyproject_path = root / "pyproject.toml"
+    if not pyproject_path.exists():
+        return {}
+    pyproject = _load_toml(pyproject_path.read_text(encoding="utf-8"))
+    config: dict[str, Any] = pyproject.get("tool", {}).get("python-versions-hook", {})
+    return config
+
+
+class _GlobNode:
+    """A node of the glob patterns trie, after some path segments."""
+
+    def __init__(self) -> None:
+        self.children: dict[str, _GlobNode] = {}
+        self.wildcards: dict[str, _GlobNode] = {}
+        # The node of a `**` segment
+        self.recursive: _GlobNode | None = None
+        # The node is for a `**` segment, that matches any number of directories
+        self.loop = False
+        self.terminal = False
+
+
+class _GlobTrie:
+    """
+    Match the directories with glob patterns, by walking a trie of the pattern segments.
+
+    A directory that matches a pattern also matches for all its subdirectories.
+    """
+
+    def __init__(self, patterns: list[str]) -> None:
+        self.root = _GlobNode()
+        for pattern in patterns:
+            node = self.root
+            for segment in pattern.removeprefix("./").strip("/").split("/"):
+                if segment == "**":
+                    if node.recursive is None:
+                        node.recursive = _GlobNode()
+                        node.recursive.loop = True
+                    node = node.recursive
+                elif any(char in segment for char in "*?["):
+                    node = node.wildcards.setdefault(segment, _GlobNode())
+                else:
+                    node = node.children.setdefault(segment, _GlobNode())
+            node.terminal = True
+
+    def start(self) -> list[_GlobNode]:
+        """Get the state for the root directory."""
+        return self._closure([self.root])
+
+    def step(self, state: list[_GlobNode], name: str) -> list[_GlobNode]:
+        """Get the state for the subdirectory name, empty if no pattern can match in it."""
+        new_state = []
+        for node in state:
+            child = node.children.get(name)
+            if child is not None:
+                new_state.append(child)
+            new_state.extend(
+                child for pattern, child in node.wildcards.items() if fnmatch.fnmatchcase(name, pattern)
+            )
+            if node.loop:
+                new_state.append(node)
+        return self._closure(new_state)
+
+    @staticmethod
+    def matches(state: list[_GlobNode]) -> bool:
+        """Check if a pattern matches the directory."""
+        return any(node.terminal for node in state)
+
+    @staticmethod
+    def _closure(state: list[_GlobNode]) -> list[_GlobNode]:
+        """Add the nodes after the `**` that match no segment."""
+        result: list[_GlobNode] = []
+        for node in state:
+            current: _GlobNode | None = node
+            while current is not None and current not in result:
+                result.append(current)
+                current = current.recursive
+        return result
+
+
+def _get_all_directories(
+    root: Path,
+    exclude: list[str] | None = None,
+    include: list[str] | None = None,
+) -> list[Path]:
+    """
+    Get all directories in the repository, excluding __pycache__ and .git.
+
+    The excluded directories are not walked, and with include patterns only the directories
+    that can contain an included directory are walked.
+    """
+    exclude_trie = _GlobTrie(exclude or [])
+    include_trie = _GlobTrie(include) if include else None
+    result = []
+
+    def walk(
+        directory: Path,
+        exclude_state: list[_GlobNode],
+        include_state: list[_GlobNode] | None,
+    ) -> None:
+        with os.scandir(directory) as entries:
+            names = sorted(
+                entry.name
+                for entry in entries
+                if entry.is_dir(follow_symlinks=False) and entry.name not in (".git", "__pycache__")
+            )
+        for name in names:
+            child_exclude_state = exclude_trie.step(exclude_state, name)
+            if exclude_trie.matches(child_exclude_state):
+                continue
+            child_include_state = None
+            if include_trie is not None and include_state is not None:
+                child_include_state = include_trie.step(include_state, name)
+                if include_trie.matches(child_include_state):
+                    child_include_state = None
+                elif not child_include_state:
+                    continue
+            if child_include_state is None:
+                result.append(directory / name)
+            walk(directory / name, child_exclude_state, child_include_state)
+
+    walk(root, exclude_trie.start(), None if include_trie is None else include_trie.start())
+    return result
+
+
+@dataclasses.dataclass(frozen=True)
+class _VersionInterval:
+    """An interval of versions, a None bound is unbounded."""
+
+    lower: packaging.version.Version | None = None
+    lower_inclusive: bool = False
+    upper: packaging.version.Version | None = None
+    upper_inclusive: bool = False
+
+    def is_empty(self) -> bool:
+        """Check if no version is in the interval."""
+        if self.lower is None or self.upper is None:
+            return False
+        return self.lower > self.upper or (
+            self.lower == self.upper and not (self.lower_inclusive and self.upper_inclusive)
+        )
+
+    def intersection(self, other: "_VersionInterval") -> "_VersionInterval":
+        """Get the versions that are in both intervals."""
+        lower, lower_inclusive = self.lower, self.lower_inclusive
+        if other.lower is not None and (
+            lower is None or other.lower > lower or (other.lower == lower and not other.lower_inclusive)
         ):
-            version = pyproject["tool"]["poetry"]["dependencies"]["python"]
-            version = _convert_poetry_version_to_specifier(version)
-            specifier_set = packaging.specifiers.SpecifierSet(version)
-            # Normalize the order of specifiers
-            normalized_version = ",".join(sorted(str(s) for s in specifier_set))
-            return packaging.specifiers.SpecifierSet(normalized_version)
-
-        if "requires-python" in pyproject.get("project", {}):
-            return packaging.specifiers.SpecifierSet(
-                pyproject["project"]["requires-python"],
+            lower, lower_inclusive = other.lower, other.lower_inclusive
+        upper, upper_inclusive = self.upper, self.upper_inclusive
+        if other.upper is not None and (
+            upper is None or other.upper < upper or (other.upper == upper and not other.upper_inclusive)
+        ):
+            upper, upper_inclusive = other.upper, other.upper_inclusive
+        return _VersionInterval(lower, lower_inclusive, upper, upper_inclusive)
+
+    def minors(self, major: int, last_minor: int) -> range:
+        """Get the minor versions of a major version that are in the interval, up to the last minor."""
+        start = 0
+        if self.lower is not None:
+            if self.lower.major > major:
+                return range(0)
+            if self.lower.major == major:
+                start = self.lower.minor
+                candidate = packaging.version.Version(f"{major}.{start}")
+                if candidate < self.lower or (candidate == self.lower and not self.lower_inclusive):
+                    start += 1
+        end = last_minor
+        if self.upper is not None:
+            if self.upper.major < major:
+                return range(0)
+            if self.upper.major == major:
+                upper_minor = self.upper.minor
+                candidate = packaging.version.Version(f"{major}.{upper_minor}")
+                if candidate > self.upper or (candidate == self.upper and not self.upper_inclusive):
+                    upper_minor -= 1
+                end = min(end, upper_minor)
+        return range(start, end + 1)
+
+
+def _get_specifier_intervals(specifier: packaging.specifiers.Specifier) -> list[_VersionInterval]:
+    """Get the intervals of the versions that match a specifier."""
+    operator = specifier.operator
+    if specifier.version.endswith(".*"):
+        prefix = packaging.version.Version(specifier.version[:-2])
+        next_prefix = packaging.version.Version(
+            ".".join(str(part) for part in [*prefix.release[:-1], prefix.release[-1] + 1]),
+        )
+        if operator == "==":
+            return [_VersionInterval(lower=prefix, lower_inclusive=True, upper=next_prefix)]
+        # !=
+        return [_VersionInterval(upper=prefix), _VersionInterval(lower=next_prefix, lower_inclusive=True)]
+
+    try:
+        version = packaging.version.Version(specifier.version)
+    except packaging.version.InvalidVersion:
+        # Arbitrary equality with a string that isn't a version
+        return []
+    if operator == "~=":
+        next_prefix = packaging.version.Version(
+            ".".join(str(part) for part in [*version.release[:-2], version.release[-2] + 1]),
+        )
+        return [_VersionInterval(lower=version, lower_inclusive=True, upper=next_prefix)]
+    if operator in ("==", "==="):
+        return [_VersionInterval(lower=version, lower_inclusive=True, upper=version, upper_inclusive=True)]
+    if operator == "!=":
+        return [_VersionInterval(upper=version), _VersionInterval(lower=version)]
+    if operator in ("<", "<="):
+        return [_VersionInterval(upper=version, upper_inclusive=operator == "<=")]
+    # > or >=
+    return [_VersionInterval(lower=version, lower_inclusive=operator == ">=")]
+
+
+def _get_version_intervals(
+    version_set: packaging.specifiers.SpecifierSet | str,
+) -> list[_VersionInterval]:
+    """
+    Get the sorted and disjoint intervals of the versions that match the specifiers.
+
+    The Poetry specifiers like `^3.10` are also supported.
+    """
+    if isinstance(version_set, str):
+        version_set = packaging.specifiers.SpecifierSet(_convert_poetry_version_to_specifier(version_set))
+
+    intervals = [_VersionInterval()]
+    for specifier in version_set:
+        assert isinstance(specifier, packaging.specifiers.Specifier)
+        intervals = [
+            intersection
+            for interval in intervals
+            for specifier_interval in _get_specifier_intervals(specifier)
+            if not (intersection := interval.intersection(specifier_interval)).is_empty()
+        ]
+
+    intervals.sort(
+        key=lambda interval: (
+            (0,) if interval.lower is None else (1, interval.lower, not interval.lower_inclusive)
+        ),
+    )
+    result: list[_VersionInterval] = []
+    for interval in intervals:
+        if result:
+            previous = result[-1]
+            if (
+                previous.upper is None
+                or interval.lower is None
+                or interval.lower < previous.upper
+                or (
+                    interval.lower == previous.upper
+                    and (interval.lower_inclusive or previous.upper_inclusive)
+                )
+            ):
+                # Overlapping or adjacent intervals
+                if previous.upper is not None and (
+                    interval.upper is None
+                    or interval.upper > previous.upper
+                    or (interval.upper == previous.upper and interval.upper_inclusive)
+                ):
+                    result[-1] = dataclasses.replace(
+                        previous,
+                        upper=interval.upper,
+                        upper_inclusive=interval.upper_inclusive,
+                    )
+                continue
+        result.append(interval)
+    return result
+
+
+# The last minor version of the major versions that are finished,
+# should be completed with the embedded .python-version on a new major version
+_LAST_MINOR_VERSIONS = {2: 7}
+
+
+def _get_supported_versions(
+    version_set: packaging.specifiers.SpecifierSet,
+    first_version: packaging.version.Version,
+    last_version: packaging.version.Version,
+) -> list[packaging.version.Version]:
+    """
+    Get the minor versions between first_version and last_version that match the version set.
+
+    The minor versions of the major versions before the last one are known from `_LAST_MINOR_VERSIONS`.
+    """
+    intervals = _get_version_intervals(version_set)
+    all_version: list[packaging.version.Version] = []
+    for major in range(first_version.major, last_version.major + 1):
+        first_minor = first_version.minor if major == first_version.major else 0
+        last_minor = (
+            last_version.minor if major == last_version.major else _LAST_MINOR_VERSIONS.get(major, -1)
+        )
+        for interval in intervals:
+            minors = interval.minors(major, last_minor)
+            all_version.extend(
+                packaging.version.Version(f"{major}.{minor}")
+                for minor in range(max(minors.start, first_minor), minors.stop)
             )
+    return all_version
+
+
+@dataclasses.dataclass
+class DirectoryReport:
+    """The Python versions of a directory, and the files updated in it."""
+
+    directory: Path
+    # The Python version specifiers, or the version of the .python-version file
+    version: packaging.specifiers.SpecifierSet | packaging.version.Version
+    minimal_version: packaging.version.Version
+    # The supported minor versions, up to the last known version
+    supported_versions: list[packaging.version.Version]
+    first_version: packaging.version.Version
+    last_version: packaging.version.Version
+    changed_files: list[Path] = dataclasses.field(default_factory=list)
+    # The time spent to update the files of the directory, in seconds
+    duration: float = 0
+
+
+@dataclasses.dataclass
+class Report:
+    """The result of the synchronization of the Python versions in a repository."""
+
+    directories: list[DirectoryReport]
+    # The total time, in seconds
+    duration: float
+
+    @property
+    def changed_files(self) -> list[Path]:
+        """Get all the updated files."""
+        return [file for directory in self.directories for file in directory.changed_files]
+
+
+def _get_directory_report(directory: Path, root: Path | None = None) -> DirectoryReport | None:
+    """Get the Python versions of a directory, None if no supported version is found."""
+    version = _detect_python_version(directory, root)
+    if version is None:
         return None
 
+    first_version, last_version = _get_python_version(directory)
 
-def _get_all_directories() -> list[Path]:
-    """Get all directories in the repository, excluding __pycache__ and .git."""
-    result = subprocess.run(
-        ["find", ".", "-type", "d", "-not", "-path", "./.git/*", "-not", "-path", "./__pycache__/*"],  # noqa: S607
-        check=True,
-        stdout=subprocess.PIPE,
-        encoding="utf-8",
+    if isinstance(version, packaging.specifiers.SpecifierSet):
+        supported_versions = _get_supported_versions(version, first_version, last_version)
+        if not supported_versions:
+            return None
+        minimal_version = supported_versions[0]
+    else:
+        # version is a packaging.version.Version
+        minimal_version = version
+        supported_versions = [packaging.version.Version(f"{version.major}.{version.minor}")]
+
+    return DirectoryReport(
+        directory=directory,
+        version=version,
+        minimal_version=minimal_version,
+        supported_versions=supported_versions,
+        first_version=first_version,
+        last_version=last_version,
+    )
+
+
+def sync_python_versions(
+    root: Path | str = ".",
+    *,
+    check: bool = False,
+    jobs: int = 1,
+    files: list[Path] | list[str] | None = None,
+    cache_directory: Path | None = None,
+) -> Report:
+    """
+    Update the Python versions in all the project files of a repository.
+
+    The directories are updated in parallel with `jobs` > 1, the parent directories before their
+    children. In `check` mode the files are not written, the differences are printed.
+
+    With `files`, only the directories of these files, and their subdirectories, are updated.
+    The updated files are locked, then many processes can update the same repository.
+
+    The embedded Python version and the package versions from PyPI are cached across the calls,
+    and across the processes in the `cache_directory`.
+    """
+    start = time.perf_counter()
+    root = Path(root)
+    config = _get_root_config(root)
+    run = _Run(
+        _Network.from_config(config),
+        check=check,
+        run_pre_commit=root.resolve() == Path.cwd().resolve(),
+        cache_directory=cache_directory,
+    )
+
+    def update(directory: Path) -> DirectoryReport | None:
+        directory_start = time.perf_counter()
+        directory_update = _DirectoryUpdate(run)
+        # The Python version should not change during the update of the directory
+        with directory_update.lock_version_files(directory, root):
+            report = _get_directory_report(directory, root)
+            if report is None:
+                return None
+            _update_directory_files(
+                directory,
+                report.minimal_version,
+                report.first_version,
+                report.last_version,
+                directory_update,
+                report.supported_versions,
+            )
+        directory_update.format_files()
+        report.changed_files = directory_update.changed_files
+        report.duration = time.perf_counter() - directory_start
+        return report
+
+    directories = _get_all_directories(root, config.get("exclude"), config.get("include"))
+    if files is not None:
+        files_directories = {Path(root, file).resolve().parent for file in files}
+        directories = [
+            directory
+            for directory in directories
+            if not files_directories.isdisjoint([directory.resolve(), *directory.resolve().parents])
+        ]
+    if jobs <= 1:
+        reports = [update(directory) for directory in directories]
+    else:
+        # The version of a directory depends on the files of its parents
+        reports_by_directory: dict[Path, DirectoryReport | None] = {}
+        by_depth: dict[int, list[Path]] = {}
+        for directory in directories:
+            by_depth.setdefault(len(directory.relative_to(root).parts), []).append(directory)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for depth in sorted(by_depth):
+                reports_by_directory.update(
+                    zip(by_depth[depth], executor.map(update, by_depth[depth]), strict=True),
+                )
+        reports = [reports_by_directory[directory] for directory in directories]
+
+    return Report(
+        directories=[report for report in reports if report is not None],
+        duration=time.perf_counter() - start,
     )
-    return [Path(directory) for directory in result.stdout.splitlines() if directory != "."]
 
 
 def main() -> None:
     """Python version configurations in all project files."""
     args_parser = argparse.ArgumentParser("Update the Python versions in all the project files")
-    args_parser.parse_args()
-
-    # Process each directory independently
-    for directory in _get_all_directories():
-        version = _detect_python_version(directory)
-        if version is None:
-            continue
+    args_parser.add_argument(
+        "--matrix",
+        nargs="?",
+        const=".",
+        metavar="DIRECTORY",
+        help="Print the supported Python versions of the directory as a JSON CI matrix, "
+        "without updating the files",
+    )
+    args_parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Don't update the files, print the differences and exit with an error if there are some",
+    )
+    args_parser.add_argument(
+        "--jobs", type=int, default=1, help="The number of directories updated in parallel"
+    )
+    args_parser.add_argument(
+        "files",
+        nargs="*",
+        type=Path,
+        help="Only update the directories of these files, and their subdirectories, "
+        "the other running processes can update the same repository",
+    )
+    args = args_parser.parse_args()
 
-        first_version, last_version = _get_python_version(directory)
-        assert first_version.major == last_version.major
+    if args.matrix is not None:
+        directory_report = _get_directory_report(Path(args.matrix))
+        supported_versions = [] if directory_report is None else directory_report.supported_versions
+        print(json.dumps({"python-version": [_minor_version(version) for version in supported_versions]}))
+        return
 
-        minimal_version = None
-        if isinstance(version, packaging.specifiers.SpecifierSet):
-            for minor in range(first_version.minor, last_version.minor + 1):
-                current_version = packaging.version.parse(f"{first_version.major}.{minor}")
-                if version.contains(current_version) and minimal_version is None:
-                    minimal_version = current_version
+    report = sync_python_versions(
+        ".",
+        check=args.check,
+        jobs=args.jobs,
+        files=args.files or None,
+        cache_directory=_get_cache_directory() if args.files else None,
+    )
+    if args.check and report.changed_files:
+        sys.exit(1)
+
+
+def _minor_version(version: packaging.version.Version) -> str:
+    return f"{version.major}.{version.minor}"
+
+
+def _get_cache_directory() -> Path:
+    """Get the directory of the cache shared by the processes."""
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "python-versions-hook"
+
+
+_EditorT = TypeVar("_EditorT", mra.EditTOML, mra.EditYAML, mra.EditPreCommitConfig, mra.EditConfig)
+
+
+class _Run:
+    """The state shared by the updates of all the directories."""
+
+    def __init__(
+        self,
+        network: "_Network | None" = None,
+        check: bool = False,
+        run_pre_commit: bool = True,
+        cache_directory: Path | None = None,
+    ) -> None:
+        self.network = _Network() if network is None else network
+        self.check = check
+        self.run_pre_commit = run_pre_commit
+        self.cache_directory = cache_directory
+        # The editors also update the root pre-commit configuration
+        self.editor_lock = threading.Lock()
+
+
+@functools.cache
+def _get_default_run() -> _Run:
+    """Get the run shared by the updates that are done without a run."""
+    return _Run()
+
+
+class _DirectoryUpdate:
+    """The update of the files of a directory, that records the changed files."""
+
+    def __init__(self, run: _Run | None = None) -> None:
+        self.run = _get_default_run() if run is None else run
+        self.changed_files: list[Path] = []
+        # The modified files that should be formatted, with their editor class
+        self.formats: list[tuple[Path, type[mra.EditTOML | mra.EditYAML | mra.EditConfig]]] = []
+
+    def write(
+        self,
+        path: Path,
+        content: str,
+        new_content: str,
+        editor_class: type[mra.EditTOML | mra.EditYAML | mra.EditConfig] | None = None,
+    ) -> None:
+        """
+        Write the new content of a file, in check mode only print the differences.
+
+        The file is formatted by `format_files` like with the full round-trip `editor_class`.
+        """
+        if new_content == content:
+            return
+        self.changed_files.append(path)
+        if editor_class is not None and self.run.run_pre_commit and not self.run.check:
+            self.formats.append((path, editor_class))
+        if self.run.check:
+            sys.stdout.writelines(
+                difflib.unified_diff(
+                    content.splitlines(keepends=True),
+                    new_content.splitlines(keepends=True),
+                    fromfile=str(path),
+                    tofile=str(path),
+                ),
+            )
         else:
-            # version is a packaging.version.Version
-            minimal_version = version
+            path.write_text(new_content, encoding="utf-8")
+
+    def lock(self, *paths: Path) -> contextlib.AbstractContextManager[None]:
+        """Lock the files that will be updated, for the other running processes."""
+        if self.run.check:
+            return _lock_files([], list(paths))
+        return _lock_files(list(paths))
+
+    def lock_version_files(self, directory: Path, root: Path) -> contextlib.AbstractContextManager[None]:
+        """Lock the files from which the Python version of the directory is detected, up to the root."""
+        inherited_paths = []
+        for parent in directory.parents:
+            inherited_paths += [parent / "pyproject.toml", parent / ".python-version"]
+            if parent == root:
+                break
+        paths = [directory / "pyproject.toml", directory / ".python-version"]
+        if self.run.check:
+            return _lock_files([], [*paths, *inherited_paths])
+        return _lock_files(paths, inherited_paths)
+
+    @contextlib.contextmanager
+    def edit(self, editor_class: type[_EditorT], path: Path) -> Iterator[_EditorT]:
+        """Edit a file with a full round-trip editor, the modified file is formatted by `format_files`."""
+        with self.run.editor_lock, self.lock(path):
+            content = None if self.run.check else path.read_text(encoding="utf-8")
+            with editor_class(
+                path,
+                diff=self.run.check,
+                run_pre_commit=False,
+                add_pre_commit_configuration_if_modified=False,
+            ) as editor:
+                yield editor
+            if editor.is_modified() if self.run.check else path.read_text(encoding="utf-8") != content:
+                self.changed_files.append(path)
+                if self.run.run_pre_commit and not self.run.check:
+                    self.formats.append((path, editor_class))
+
+    def format_files(self) -> None:
+        """
+        Add the formatting hook of the modified files in the root pre-commit configuration and run it.
+
+        Should be called when the files are not locked anymore, because pre-commit can run this hook.
+        """
+        for path, editor_class in self.formats:
+            with self.run.editor_lock:
+                with self.lock(Path(".pre-commit-config.yaml")):
+                    editor_class(
+                        path,
+                        run_pre_commit=False,
+                        add_pre_commit_configuration_if_modified=False,
+                    ).add_pre_commit_hook()
+                if Path(".pre-commit-config.yaml").exists():
+                    try:
+                        mra.run(
+                            [
+                                *multi_repo_automation.tools.get_pre_commit_run(),
+                                "--color=never",
+                                f"--files={path}",
+                            ],
+                            exit_on_error=False,
+                        )
+                    except subprocess.TimeoutExpired as exc:
+                        print(exc)
+        self.formats = []
 
-        if minimal_version is None:
-            continue
 
-        # Update files in the current directory only
-        _update_files_in_directory(directory, minimal_version, first_version, last_version)
+def _update_files_in_directory(
+    directory: Path,
+    minimal_version: packaging.version.Version,
+    first_version: packaging.version.Version,
+    last_version: packaging.version.Version,
+    run: _Run | None = None,
+    supported_versions: list[packaging.version.Version] | None = None,
+) -> list[Path]:
+    """Update Python version configurations in all project files for a specific directory."""
+    update = _DirectoryUpdate(run)
+    _update_directory_files(
+        directory, minimal_version, first_version, last_version, update, supported_versions
+    )
+    update.format_files()
+    return update.changed_files
 
 
-def _update_files_in_directory(
+def _update_directory_files(
     directory: Path,
     minimal_version: packaging.version.Version,
     first_version: packaging.version.Version,
     last_version: packaging.version.Version,
+    update: _DirectoryUpdate,
+    supported_versions: list[packaging.version.Version] | None = None,
 ) -> None:
-    """Update Python version configurations in all project files for a specific directory."""
+    """Update the files of a directory, without formatting them."""
     # In pyproject.toml
     pyproject_path = directory / "pyproject.toml"
-    if pyproject_path.exists():
-        with mra.EditTOML(pyproject_path) as pyproject:
-            if "python_version" in pyproject.get("tool", {}).get("mypy", {}):
-                pyproject["tool"]["mypy"]["python_version"] = str(minimal_version)
-
-            if "target-version" in pyproject.get("tool", {}).get("black", {}):
-                pyproject["tool"]["black"]["target-version"] = [
-                    f"py{minimal_version.major}{minimal_version.minor}",
-                ]
-
-            if "target-version" in pyproject.get("tool", {}).get("ruff", {}):
-                pyproject["tool"]["ruff"]["target-version"] = (
-                    f"py{minimal_version.major}{minimal_version.minor}"
-                )
-
-            version_set = _get_python_specifiers_version(pyproject_path)
-            if version_set is None:
-                return
-
-            all_version = []
-            for minor in range(first_version.minor, last_version.minor + 1):
-                current_version = packaging.version.parse(f"{first_version.major}.{minor}")
-                if version_set.contains(current_version):
-                    all_version.append(current_version)
-
-            config = pyproject.get("tool", {}).get("python-versions-hook", {})
-            keep_requires_python = config.get("keep-requires-python", False)
-            if not keep_requires_python and "project" in pyproject:
-                pyproject["project"]["requires-python"] = f">={minimal_version}"
-
-            has_classifiers = False
-            has_poetry_classifiers = False
-            classifiers = []
-            if "classifiers" in pyproject.get("project", {}):
-                has_classifiers = True
-                classifiers = pyproject["project"]["classifiers"]
-            elif "classifiers" in pyproject.get("tool", {}).get(
-                "poetry",
-                {},
-            ) and "python" in pyproject.get("tool", {}).get("poetry", {}).get(
-                "dependencies",
-                {},
-            ):
-                has_classifiers = True
-                has_poetry_classifiers = True
-                classifiers = pyproject["tool"]["poetry"]["classifiers"]
-
-            if not has_classifiers:
-                return
-
-            classifiers = [c for c in classifiers if not c.startswith("Programming Language :: Python")]
-            classifiers.append("Programming Language :: Python")
-            classifiers.append("Programming Language :: Python :: 3")
-            for current_version in all_version:
-                classifiers.append(f"Programming Language :: Python :: {current_version}")
-
-            classifier_item = tomlkit.array(
-                sorted(classifiers, key=_natural_sort_key),  # type: ignore[arg-type]
-            ).multiline(multiline=True)
-            if has_poetry_classifiers:
-                pyproject["tool"]["poetry"]["classifiers"] = classifier_item
-            else:
-                pyproject["project"]["classifiers"] = classifier_item
-
-            _tweak_dependency_version(pyproject)
+    if pyproject_path.exists() and not _update_pyproject(
+        pyproject_path,
+        minimal_version,
+        first_version,
+        last_version,
+        update,
+    ):
+        return
 
     # In .pre-commit-config.yaml (local)
     pre_commit_config_path = directory / ".pre-commit-config.yaml"
-    if pre_commit_config_path.exists():
-        with mra.EditPreCommitConfig(pre_commit_config_path) as pre_commit:
+    if pre_commit_config_path.exists() and not _patch_yaml_file(
+        pre_commit_config_path,
+        _pre_commit_assignments,
+        minimal_version,
+        update,
+        mra.EditPreCommitConfig,
+    ):
+        with update.edit(mra.EditPreCommitConfig, pre_commit_config_path) as pre_commit:
             if "python" in pre_commit.get("default_language_version", {}):
                 pre_commit["default_language_version"]["python"] = (
                     f"{minimal_version.major}.{minimal_version.minor}"
                 )
 
-            if "https://github.com/asottile/pyupgrade" in pre_commit.repos_hooks:
-                pre_commit.repos_hooks["https://github.com/asottile/pyupgrade"]["repo"]["hooks"][0][
-                    "args"
-                ] = [
+            if _PYUPGRADE_REPOSITORY in pre_commit.repos_hooks:
+                pre_commit.repos_hooks[_PYUPGRADE_REPOSITORY]["repo"]["hooks"][0]["args"] = [
                     (f"--py{minimal_version.major}{minimal_version.minor}-plus"),
                 ]
 
     # In .python-version (local)
     python_version_path = directory / ".python-version"
     if python_version_path.exists():
-        python_version_path.write_text(f"{minimal_version.major}.{minimal_version.minor}\n")
+        with update.lock(python_version_path):
+            update.write(
+                python_version_path,
+                python_version_path.read_text(encoding="utf-8"),
+                f"{minimal_version.major}.{minimal_version.minor}\n",
+            )
 
     # In all .prospector.yaml files (local)
     for prospector_path in directory.glob("*.prospector.yaml"):
-        with mra.EditYAML(prospector_path) as yaml:
+        if _patch_yaml_file(prospector_path, _prospector_assignments, minimal_version, update):
+            continue
+        with update.edit(mra.EditYAML, prospector_path) as yaml:
             yaml.setdefault("mypy", {}).setdefault("options", {})["python-version"] = (
                 f"{minimal_version.major}.{minimal_version.minor}"
             )
@@ -288,18 +908,795 @@ def _update_files_in_directory(
 
     # In jsonschema-gentypes.yaml (local)
     jsonschema_gentypes_path = directory / "jsonschema-gentypes.yaml"
-    if jsonschema_gentypes_path.exists():
-        with mra.EditYAML(jsonschema_gentypes_path) as yaml:
+    if jsonschema_gentypes_path.exists() and not _patch_yaml_file(
+        jsonschema_gentypes_path,
+        _jsonschema_gentypes_assignments,
+        minimal_version,
+        update,
+    ):
+        with update.edit(mra.EditYAML, jsonschema_gentypes_path) as yaml:
             yaml["python_version"] = f"{minimal_version.major}.{minimal_version.minor}"
 
+    if supported_versions is None:
+        return
+
+    # In the GitHub workflows matrix
+    if directory.parts[-2:] == (".github", "workflows"):
+        for workflow_path in sorted([*directory.glob("*.yaml"), *directory.glob("*.yml")]):
+            _update_workflow_matrix(workflow_path, supported_versions, update)
+
+    # In tox.ini (local)
+    tox_path = directory / "tox.ini"
+    if tox_path.exists():
+        with update.edit(mra.EditConfig, tox_path) as tox:
+            if "tox" in tox and "envlist" in tox["tox"]:
+                envlist_option = tox["tox"]["envlist"]
+                envlist = _split_tox_envlist(envlist_option.value)
+                new_envlist = _get_tox_envlist(envlist, supported_versions)
+                if new_envlist != envlist:
+                    if "\n" in envlist_option.value.strip():
+                        envlist_option.set_values(new_envlist)
+                    else:
+                        envlist_option.value = ", ".join(new_envlist)
+
+
+def _update_workflow_matrix(
+    workflow_path: Path,
+    supported_versions: list[packaging.version.Version],
+    update: _DirectoryUpdate,
+) -> None:
+    """Update the `python-version` lists of the matrix in a GitHub workflow."""
+    python_versions = [_minor_version(version) for version in supported_versions]
+    with update.edit(mra.EditYAML, workflow_path) as workflow:
+        jobs = workflow.get("jobs")
+        if not isinstance(jobs, dict):
+            return
+        for job in jobs.values():
+            if not isinstance(job, dict):
+                continue
+            matrix = job.get("strategy", {}).get("matrix")
+            if not isinstance(matrix, dict) or not isinstance(matrix.get("python-version"), list):
+                continue
+            if [str(version) for version in matrix["python-version"]] != python_versions:
+                matrix["python-version"] = python_versions
+
+
+# py39, py{310,311}-django, {py39,py310}-lint, lint
+_TOX_ENV = re.compile(r"[^\s,{]*(?:\{[^}]*\}[^\s,{]*)*")
+# The Python factor of an environment name, the factors are separated by dashes
+_TOX_PYTHON_FACTOR = re.compile(
+    r"(?<![^-])(?:py[0-9]+|py\{[0-9, ]+\}|\{py[0-9]+(?: *, *py[0-9]+)*\})(?![^-])"
+)
+
+
+def _split_tox_envlist(envlist: str) -> list[str]:
+    """Split the tox envlist, by keeping the generative environments."""
+    return [env for env in _TOX_ENV.findall(envlist) if env]
+
+
+def _get_tox_envlist(envlist: list[str], supported_versions: list[packaging.version.Version]) -> list[str]:
+    """
+    Replace the Python factor of the tox environments by the supported versions.
+
+    The environments that only differ by their Python factor are replaced by the first one,
+    with all the supported versions.
+    """
+    python_envs = [f"{version.major}{version.minor}" for version in supported_versions]
+    result = []
+    replaced = set()
+    for env in envlist:
+        match = _TOX_PYTHON_FACTOR.search(env)
+        if match is None:
+            result.append(env)
+            continue
+        prefix, suffix = env[: match.start()], env[match.end() :]
+        if (prefix, suffix) in replaced:
+            continue
+        replaced.add((prefix, suffix))
+        if match.group().startswith("py{"):
+            factors = [f"py{{{','.join(python_envs)}}}"]
+        elif match.group().startswith("{"):
+            factors = [f"{{{','.join(f'py{python_env}' for python_env in python_envs)}}}"]
+        else:
+            factors = [f"py{python_env}" for python_env in python_envs]
+        result.extend(f"{prefix}{factor}{suffix}" for factor in factors)
+    return result
+
+
+def _get_classifiers_config(
+    pyproject: dict[str, Any] | mra.EditTOML,
+) -> tuple[tuple[str, ...], list[str]] | None:
+    """Get the path and the current value of the classifiers that should be updated."""
+    if "classifiers" in pyproject.get("project", {}):
+        return ("project", "classifiers"), pyproject["project"]["classifiers"]
+    if "classifiers" in pyproject.get("tool", {}).get(
+        "poetry",
+        {},
+    ) and "python" in pyproject.get("tool", {}).get("poetry", {}).get(
+        "dependencies",
+        {},
+    ):
+        return ("tool", "poetry", "classifiers"), pyproject["tool"]["poetry"]["classifiers"]
+    return None
+
+
+def _get_classifiers(
+    classifiers: list[str],
+    version_set: packaging.specifiers.SpecifierSet,
+    first_version: packaging.version.Version,
+    last_version: packaging.version.Version,
+) -> tomlkit.items.Array:
+    """Get the new classifiers, with the Python ones that match the version set."""
+    all_version = _get_supported_versions(version_set, first_version, last_version)
+
+    classifiers = [c for c in classifiers if not c.startswith("Programming Language :: Python")]
+    classifiers.append("Programming Language :: Python")
+    for major in sorted({version.major for version in all_version} or {first_version.major}):
+        classifiers.append(f"Programming Language :: Python :: {major}")
+    for current_version in all_version:
+        classifiers.append(f"Programming Language :: Python :: {current_version}")
+
+    return tomlkit.array(
+        sorted(classifiers, key=_natural_sort_key),  # type: ignore[arg-type]
+    ).multiline(multiline=True)
+
+
+def _update_pyproject(
+    pyproject_path: Path,
+    minimal_version: packaging.version.Version,
+    first_version: packaging.version.Version,
+    last_version: packaging.version.Version,
+    update: _DirectoryUpdate | None = None,
+) -> bool:
+    """
+    Update the pyproject.toml file, only replace the values when the structure doesn't change.
+
+    Return False when the other files of the directory should not be updated.
+    """
+    if update is None:
+        update = _DirectoryUpdate()
+    with update.lock(pyproject_path):
+        content = pyproject_path.read_text(encoding="utf-8")
+        patch = _patch_pyproject(content, minimal_version, first_version, last_version)
+        if patch is not None:
+            new_content, complete = patch
+            update.write(pyproject_path, content, new_content, mra.EditTOML)
+            return complete
+    # The full editor takes its own locks
+    return _edit_pyproject(pyproject_path, minimal_version, first_version, last_version, update)
+
+
+def _edit_pyproject(
+    pyproject_path: Path,
+    minimal_version: packaging.version.Version,
+    first_version: packaging.version.Version,
+    last_version: packaging.version.Version,
+    update: _DirectoryUpdate | None = None,
+) -> bool:
+    """
+    Update the pyproject.toml file with a full round-trip of the document.
+
+    Return False when the other files of the directory should not be updated.
+    """
+    if update is None:
+        update = _DirectoryUpdate()
+    with update.edit(mra.EditTOML, pyproject_path) as pyproject:
+        if "python_version" in pyproject.get("tool", {}).get("mypy", {}):
+            pyproject["tool"]["mypy"]["python_version"] = str(minimal_version)
+
+        if "target-version" in pyproject.get("tool", {}).get("black", {}):
+            pyproject["tool"]["black"]["target-version"] = [
+                f"py{minimal_version.major}{minimal_version.minor}",
+            ]
+
+        if "target-version" in pyproject.get("tool", {}).get("ruff", {}):
+            pyproject["tool"]["ruff"]["target-version"] = f"py{minimal_version.major}{minimal_version.minor}"
+
+        version_set = _get_python_specifiers_version_from_config(pyproject)
+        if version_set is None:
+            return False
+
+        config = pyproject.get("tool", {}).get("python-versions-hook", {})
+        keep_requires_python = config.get("keep-requires-python", False)
+        if not keep_requires_python and "project" in pyproject:
+            pyproject["project"]["requires-python"] = f">={minimal_version}"
+
+        classifiers_config = _get_classifiers_config(pyproject)
+        if classifiers_config is None:
+            return False
+
+        classifiers_path, classifiers = classifiers_config
+        classifier_item = _get_classifiers(classifiers, version_set, first_version, last_version)
+        if classifiers_path[0] == "tool":
+            pyproject["tool"]["poetry"]["classifiers"] = classifier_item
+        else:
+            pyproject["project"]["classifiers"] = classifier_item
+
+        _tweak_dependency_version(pyproject, update.run.network, update.run.cache_directory)
+    return True
+
+
+def _patch_pyproject(
+    content: str,
+    minimal_version: packaging.version.Version,
+    first_version: packaging.version.Version,
+    last_version: packaging.version.Version,
+) -> tuple[str, bool] | None:
+    """
+    Update the pyproject.toml content by replacing only the values that should be updated.
+
+    Return the new content and False when the other files of the directory should not be updated,
+    or None if the structure of the document should change, then the full editor should be used.
+    """
+    pyproject = _load_toml(content)
+    tool = pyproject.get("tool", {})
+    assignments: dict[tuple[str, ...], Any] = {}
+    complete = True
+
+    if "python_version" in tool.get("mypy", {}):
+        assignments["tool", "mypy", "python_version"] = str(minimal_version)
+    if "target-version" in tool.get("black", {}):
+        assignments["tool", "black", "target-version"] = [
+            f"py{minimal_version.major}{minimal_version.minor}",
+        ]
+    if "target-version" in tool.get("ruff", {}):
+        assignments["tool", "ruff", "target-version"] = f"py{minimal_version.major}{minimal_version.minor}"
+
+    version_set = _get_python_specifiers_version_from_config(pyproject)
+    classifiers_config = _get_classifiers_config(pyproject)
+    if version_set is None or classifiers_config is None:
+        complete = False
+
+    if version_set is not None:
+        keep_requires_python = tool.get("python-versions-hook", {}).get("keep-requires-python", False)
+        if not keep_requires_python and "project" in pyproject:
+            assignments["project", "requires-python"] = f">={minimal_version}"
+
+    if version_set is not None and classifiers_config is not None:
+        classifiers_path, classifiers = classifiers_config
+        assignments[classifiers_path] = _get_classifiers(
+            classifiers,
+            version_set,
+            first_version,
+            last_version,
+        )
+
+        if _get_poetry_add_dependencies(pyproject):
+            # Should add new Poetry dependencies
+            return None
+        tweaked_dependencies = _get_tweaked_dependencies(pyproject)
+        if tweaked_dependencies is not None:
+            for extra_name, dependencies in tweaked_dependencies.items():
+                if extra_name is None:
+                    assignments["project", "dependencies"] = dependencies
+                else:
+                    assignments["project", "optional-dependencies", extra_name] = dependencies
+
+    spans = _toml_value_spans(content)
+    if spans is None:
+        return None
+    new_content = _splice(
+        content,
+        spans,
+        {path: tomlkit.item(value).as_string() for path, value in assignments.items()},
+    )
+    if new_content is None:
+        return None
+    return new_content, complete
+
+
+def _load_toml(content: str) -> dict[str, Any]:
+    """Load a TOML content as plain data, without keeping the formatting."""
+    if sys.version_info >= (3, 11):
+        return tomllib.loads(content)
+    return tomlkit.parse(content).unwrap()
+
+
+def _splice(
+    content: str,
+    spans: dict[Any, tuple[int, int] | None],
+    replacements: dict[Any, str],
+) -> str | None:
+    """Replace the value spans with the new values, None if a value can't be located."""
+    edits = []
+    for path, value in replacements.items():
+        span = spans.get(path)
+        if span is None:
+            return None
+        edits.append((span, value))
+
+    for (start, end), value in sorted(edits, reverse=True):
+        content = content[:start] + value + content[end:]
+    return content
+
+
+class _TOMLScanError(Exception):
+    """The TOML document is not understood by the scanner, at the given position."""
+
+
+_TOML_BARE_KEY = re.compile(r"[A-Za-z0-9_-]+")
+_TOML_BARE_VALUE = re.compile(r"[A-Za-z0-9_:.+-]+(?: [0-9][0-9:.+Z-]*)?")
+
+
+def _toml_skip(content: str, pos: int, newlines: bool = False) -> int:
+    """Skip the white spaces, and the new lines and the comments if requested."""
+    while pos < len(content):
+        char = content[pos]
+        if char in " \t" or (newlines and char in "\r\n"):
+            pos += 1
+        elif newlines and char == "#":
+            end = content.find("\n", pos)
+            pos = len(content) if end < 0 else end
+        else:
+            break
+    return pos
+
+
+def _toml_key(content: str, pos: int) -> tuple[tuple[str, ...], int]:
+    """Parse a (dotted) key, return the key parts and the end position."""
+    parts = []
+    while True:
+        pos = _toml_skip(content, pos)
+        if content.startswith('"', pos):
+            end = _toml_value_end(content, pos)
+            parts.append(tomlkit.parse(f"a = {content[pos:end]}")["a"])
+        elif content.startswith("'", pos):
+            end = content.index("'", pos + 1) + 1
+            parts.append(content[pos + 1 : end - 1])
+        else:
+            match = _TOML_BARE_KEY.match(content, pos)
+            if match is None:
+                raise _TOMLScanError(pos)
+            end = match.end()
+            parts.append(match.group())
+        pos = _toml_skip(content, end)
+        if not content.startswith(".", pos):
+            return tuple(parts), pos
+        pos += 1
+
+
+def _toml_value_end(content: str, pos: int) -> int:
+    """Get the end position of the value that starts at the position."""
+    if content.startswith('"""', pos):
+        pos += 3
+        while not content.startswith('"""', pos):
+            if pos >= len(content):
+                raise _TOMLScanError(pos)
+            pos += 2 if content[pos] == "\\" else 1
+        pos += 3
+        while content.startswith('"', pos):
+            pos += 1
+        return pos
+    if content.startswith("'''", pos):
+        pos = content.index("'''", pos + 3) + 3
+        while content.startswith("'", pos):
+            pos += 1
+        return pos
+    if content.startswith('"', pos):
+        pos += 1
+        while content[pos] != '"':
+            if content[pos] == "\n":
+                raise _TOMLScanError(pos)
+            pos += 2 if content[pos] == "\\" else 1
+        return pos + 1
+    if content.startswith("'", pos):
+        end = content.index("'", pos + 1)
+        if "\n" in content[pos:end]:
+            raise _TOMLScanError(pos)
+        return end + 1
+    if content.startswith("[", pos):
+        pos = _toml_skip(content, pos + 1, newlines=True)
+        while not content.startswith("]", pos):
+            pos = _toml_skip(content, _toml_value_end(content, pos), newlines=True)
+            if content.startswith(",", pos):
+                pos = _toml_skip(content, pos + 1, newlines=True)
+            elif not content.startswith("]", pos):
+                raise _TOMLScanError(pos)
+        return pos + 1
+    if content.startswith("{", pos):
+        pos = _toml_skip(content, pos + 1, newlines=True)
+        while not content.startswith("}", pos):
+            _, pos = _toml_key(content, pos)
+            if not content.startswith("=", pos):
+                raise _TOMLScanError(pos)
+            pos = _toml_skip(content, _toml_value_end(content, _toml_skip(content, pos + 1)), newlines=True)
+            if content.startswith(",", pos):
+                pos = _toml_skip(content, pos + 1, newlines=True)
+            elif not content.startswith("}", pos):
+                raise _TOMLScanError(pos)
+        return pos + 1
+    match = _TOML_BARE_VALUE.match(content, pos)
+    if match is None:
+        raise _TOMLScanError(pos)
+    return match.end()
+
+
+def _toml_value_spans(content: str) -> dict[tuple[str, ...], tuple[int, int] | None] | None:
+    """
+    Get the position of all the values of a TOML document, by full key path.
+
+    The values of the arrays of tables and of the inline tables are not indexed,
+    None if the document is not understood.
+    """
+    spans: dict[tuple[str, ...], tuple[int, int] | None] = {}
+    table: tuple[str, ...] | None = ()
+    pos = 0
+    try:
+        while True:
+            pos = _toml_skip(content, pos, newlines=True)
+            if pos >= len(content):
+                return spans
+            if content.startswith("[[", pos):
+                _, pos = _toml_key(content, pos + 2)
+                if not content.startswith("]]", pos):
+                    return None
+                pos += 2
+                table = None
+            elif content.startswith("[", pos):
+                table, pos = _toml_key(content, pos + 1)
+                if not content.startswith("]", pos):
+                    return None
+                pos += 1
+            else:
+                key, pos = _toml_key(content, pos)
+                if not content.startswith("=", pos):
+                    return None
+                start = _toml_skip(content, pos + 1)
+                pos = _toml_value_end(content, start)
+                if table is not None:
+                    spans[table + key] = (start, pos)
+            pos = _toml_skip(content, pos)
+            if content.startswith("#", pos):
+                end = content.find("\n", pos)
+                pos = len(content) if end < 0 else end
+            if pos < len(content) and content[pos] not in "\r\n":
+                return None
+    except (_TOMLScanError, ValueError, IndexError, tomlkit.exceptions.ParseError):
+        return None
+
+
+_PYUPGRADE_REPOSITORY = "https://github.com/asottile/pyupgrade"
+
+_YAML_KEY = re.compile(r"""([A-Za-z0-9_][^:#]*?|"[^"\n]*"|'[^'\n]*')[ \t]*:(?:[ \t]+|$)""")
+
+_YAML_BLOCK_SCALAR = re.compile(r"[|>][-+0-9]*[ \t]*(?:#.*)?$")
+
+_YamlPath = tuple[str | int, ...]
+
+
+def _yaml_scalar_end(line: str, pos: int) -> int | None:
+    """Get the end of the single line scalar that starts at the position, None if it's not supported."""
+    if pos >= len(line) or line[pos] == "#":
+        return pos
+    char = line[pos]
+    if char in "[{":
+        # Single line flow collection
+        depth = 0
+        end = pos
+        while end < len(line):
+            if line[end] in "\"'":
+                quoted_end = _yaml_scalar_end(line, end)
+                if quoted_end is None:
+                    return None
+                end = quoted_end
+                continue
+            if line[end] in "[{":
+                depth += 1
+            elif line[end] in "]}":
+                depth -= 1
+                if depth == 0:
+                    return end + 1
+            end += 1
+        return None
+    if char in "&*!|>@`%":
+        return None
+    if char == '"':
+        end = pos + 1
+        while end < len(line) and line[end] != '"':
+            end += 2 if line[end] == "\\" else 1
+        return end + 1 if end < len(line) else None
+    if char == "'":
+        end = pos + 1
+        while True:
+            end = line.find("'", end)
+            if end < 0:
+                return None
+            if not line.startswith("''", end):
+                return end + 1
+            end += 2
+    comment = line.find(" #", pos)
+    return len(line.rstrip()) if comment < 0 else len(line[:comment].rstrip())
+
+
+def _yaml_value_spans(content: str) -> dict[_YamlPath, tuple[int, int] | None] | None:
+    """
+    Get the position of all the values of a block style YAML document, by full path.
+
+    The containers are indexed with None, None if the document is not understood.
+    """
+    spans: dict[_YamlPath, tuple[int, int] | None] = {}
+    # Indentation, path, and whether it's a sequence item
+    stack: list[tuple[int, _YamlPath, bool]] = [(-1, (), False)]
+    sequences_length: dict[_YamlPath, int] = {}
+    # The indentation of the current block scalar
+    block_indent: int | None = None
+    line_start = 0
+    for line in content.splitlines(keepends=True):
+        offset = line_start
+        line_start += len(line)
+        line = line.rstrip("\r\n")  # noqa: PLW2901
+        stripped = line.lstrip(" ")
+        if not stripped or stripped.startswith("#"):
+            continue
+        if stripped.startswith("\t"):
+            return None
+        if line in ("---", "...") and not spans:
+            continue
+        indent = len(line) - len(stripped)
+        if block_indent is not None:
+            if indent > block_indent:
+                continue
+            block_indent = None
+
+        # Sequence items, possibly nested on the same line
+        item = False
+        while stripped.startswith("-") and stripped[1:2] in ("", " "):
+            while len(stack) > 1 and (stack[-1][0] > indent or (stack[-1][0] == indent and stack[-1][2])):
+                stack.pop()
+            parent_path = stack[-1][1]
+            index = sequences_length.get(parent_path, 0)
+            sequences_length[parent_path] = index + 1
+            path = (*parent_path, index)
+            spans[path] = None
+            stack.append((indent, path, True))
+            rest = stripped[1:].lstrip(" ")
+            indent += len(stripped) - len(rest)
+            stripped = rest
+            item = True
+        if not stripped or stripped.startswith("#"):
+            continue
+
+        match = _YAML_KEY.match(stripped)
+        if match is None:
+            if not item:
+                return None
+            if _YAML_BLOCK_SCALAR.match(stripped):
+                block_indent = stack[-1][0]
+                continue
+            end = _yaml_scalar_end(line, indent)
+            if end is None:
+                return None
+            spans[stack[-1][1]] = (offset + indent, offset + end)
+            continue
+
+        # Mapping key
+        while len(stack) > 1 and stack[-1][0] >= indent:
+            stack.pop()
+        key = match.group(1)
+        if key[0] in "\"'":
+            key = key[1:-1]
+        path = (*stack[-1][1], key)
+        sequences_length.pop(path, None)
+        start = indent + match.end()
+        if _YAML_BLOCK_SCALAR.match(line, start):
+            spans[path] = None
+            block_indent = indent
+            continue
+        end = _yaml_scalar_end(line, start)
+        if end is None:
+            return None
+        if end == start:
+            spans[path] = None
+            stack.append((indent, path, False))
+        else:
+            spans[path] = (offset + start, offset + end)
+    return spans
+
+
+@functools.lru_cache
+def _yaml_scalar(value: str) -> str:
+    """Get the YAML representation of a string scalar, as written by the YAML editor."""
+    out = io.StringIO()
+    yaml = ruamel.yaml.YAML()
+    yaml.width = 110
+    yaml.dump({"key": value}, out)
+    return out.getvalue()[len("key: ") :].rstrip("\n")
+
+
+def _patch_yaml_file(
+    path: Path,
+    get_assignments: Callable[
+        [str, dict[_YamlPath, tuple[int, int] | None], packaging.version.Version],
+        dict[_YamlPath, str] | None,
+    ],
+    minimal_version: packaging.version.Version,
+    update: _DirectoryUpdate,
+    editor_class: type[mra.EditYAML] = mra.EditYAML,
+) -> bool:
+    """
+    Update a YAML file by replacing only the values that should be updated.
+
+    Return False if the structure of the document should change, then the full editor should be used.
+    """
+    with update.lock(path):
+        content = path.read_text(encoding="utf-8")
+        spans = _yaml_value_spans(content)
+        if spans is None:
+            return False
+        assignments = get_assignments(content, spans, minimal_version)
+        if assignments is None:
+            return False
+        new_content = _splice(
+            content,
+            spans,
+            {key: _yaml_scalar(value) for key, value in assignments.items()},
+        )
+        if new_content is None:
+            return False
+        update.write(path, content, new_content, editor_class)
+        return True
+
+
+def _yaml_string(content: str, span: tuple[int, int] | None) -> str | None:
+    """Get the string value of a scalar span."""
+    if span is None:
+        return None
+    value = content[span[0] : span[1]]
+    if value[:1] in ("'", '"'):
+        return str(ruamel.yaml.YAML(typ="safe").load(value))
+    return value
+
+
+def _pre_commit_assignments(
+    content: str,
+    spans: dict[_YamlPath, tuple[int, int] | None],
+    minimal_version: packaging.version.Version,
+) -> dict[_YamlPath, str] | None:
+    """Get the values to update in the .pre-commit-config.yaml file."""
+    if ("repos",) not in spans:
+        return None
+    for path, span in spans.items():
+        if len(path) == 5 and path[2] == "hooks" and path[4] in ("files", "exclude"):
+            # The pre-commit editor rewrites the verbose regex as a literal block, and splits the long ones
+            value = _yaml_string(content, span)
+            if value is None or value.strip().startswith("(?x)") or len(value) > 60:
+                return None
+
+    assignments: dict[_YamlPath, str] = {}
+    if ("default_language_version", "python") in spans:
+        assignments["default_language_version", "python"] = f"{minimal_version.major}.{minimal_version.minor}"
+
+    index = 0
+    while ("repos", index) in spans:
+        if _yaml_string(content, spans.get(("repos", index, "repo"))) == _PYUPGRADE_REPOSITORY:
+            args_path = ("repos", index, "hooks", 0, "args")
+            if spans.get(args_path, ()) is not None or (*args_path, 1) in spans:
+                # Not a block sequence with one item
+                return None
+            assignments[(*args_path, 0)] = f"--py{minimal_version.major}{minimal_version.minor}-plus"
+            break
+        index += 1
+    return assignments
+
+
+def _prospector_assignments(
+    content: str,
+    spans: dict[_YamlPath, tuple[int, int] | None],
+    minimal_version: packaging.version.Version,
+) -> dict[_YamlPath, str] | None:
+    """Get the values to update in the .prospector.yaml files."""
+    del content, spans
+    return {
+        ("mypy", "options", "python-version"): f"{minimal_version.major}.{minimal_version.minor}",
+        ("ruff", "options", "target-version"): f"py{minimal_version.major}{minimal_version.minor}",
+    }
+
+
+def _jsonschema_gentypes_assignments(
+    content: str,
+    spans: dict[_YamlPath, tuple[int, int] | None],
+    minimal_version: packaging.version.Version,
+) -> dict[_YamlPath, str] | None:
+    """Get the values to update in the jsonschema-gentypes.yaml file."""
+    del content, spans
+    return {("python_version",): f"{minimal_version.major}.{minimal_version.minor}"}
+
+
+class _NetworkUnavailableError(requests.RequestException):
+    """The network is not used anymore, because of too many failures or the exhausted time budget."""
+
+    def __init__(self, budget_exhausted: bool) -> None:
+        super().__init__(
+            "Network time budget exhausted" if budget_exhausted else "Too many consecutive network failures",
+        )
+
+
+class _Network:
+    """
+    Access to the network with bounded latency.
+
+    The retryable responses (429 and 5xx) are retried with an exponential backoff with jitter,
+    after `max_failures` consecutive failures the circuit breaker is opened and all the next
+    requests fail immediately, and no request is done after the global time budget, that starts
+    with the first request.
+    """
+
+    def __init__(
+        self,
+        budget: float = 60,
+        connect_timeout: float = 5,
+        read_timeout: float = 30,
+        max_failures: int = 3,
+        retries: int = 2,
+        session: requests.Session | None = None,
+    ) -> None:
+        self.budget = budget
+        self.deadline: float | None = None
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_failures = max_failures
+        self.retries = retries
+        self.session = requests.Session() if session is None else session
+        self.failures = 0
+
+    @classmethod
+    def from_config(cls, config: dict[str, Any]) -> "_Network":
+        """Create the network access from the `[tool.python-versions-hook]` configuration."""
+        return cls(
+            budget=config.get("network-budget", 60),
+            connect_timeout=config.get("network-connect-timeout", 5),
+            read_timeout=config.get("network-read-timeout", 30),
+            max_failures=config.get("network-max-failures", 3),
+        )
+
+    def get(self, url: str) -> requests.Response:
+        """Get the URL, raise a `requests.RequestException` on error."""
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.budget
+        attempt = 0
+        while True:
+            if self.failures >= self.max_failures:
+                raise _NetworkUnavailableError(budget_exhausted=False)
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise _NetworkUnavailableError(budget_exhausted=True)
+
+            try:
+                response = self.session.get(
+                    url,
+                    timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining)),
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                self.failures += 1
+                raise
+
+            if response.status_code != 429 and response.status_code < 500:
+                self.failures = 0
+                response.raise_for_status()
+                return response
+
+            delay = self._retry_delay(response, attempt)
+            if attempt >= self.retries or delay >= self.deadline - time.monotonic():
+                self.failures += 1
+                response.raise_for_status()
+            attempt += 1
+            time.sleep(delay)
+
+    @staticmethod
+    def _retry_delay(response: requests.Response, attempt: int) -> float:
+        """Get the delay before the next attempt, from the Retry-After header or with a backoff."""
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+        return min(30.0, 2.0**attempt) * random.uniform(0.5, 1)  # noqa: S311 # nosec
+
 
 # beaker (>=1.13.0,<2.0.0)
 _POETRY_ADD_PACKAGE_REGEX = re.compile(r"([a-z][a-z0-9_-]*) \(>=([0-9][0-9\.a-z-]+),<([0-9][0-9\.a-z-]+)\)$")
 
 
-def _tweak_dependency_version(pyproject: mra.EditTOML) -> None:
-    """Tweak the dependency version in pyproject.toml."""
-
+def _get_poetry_add_dependencies(pyproject: dict[str, Any] | mra.EditTOML) -> list[re.Match[str]]:
+    """Get the dependencies added with `poetry add` that are missing in the Poetry dependencies."""
     all_poetry_deps = set(pyproject.get("tool", {}).get("poetry", {}).get("dependencies", {}).keys())
     for group_deps in (
         pyproject.get("tool", {})
@@ -313,166 +1710,234 @@ def _tweak_dependency_version(pyproject: mra.EditTOML) -> None:
         if isinstance(group_deps, dict):
             all_poetry_deps.update(group_deps.get("dependencies", {}).keys())
 
+    result = []
     current_project_dependencies = pyproject.get("project", {}).get("dependencies", [])
     for full_dependencies in current_project_dependencies:
         if isinstance(full_dependencies, str):
             match = _POETRY_ADD_PACKAGE_REGEX.match(full_dependencies)
             if match and match.group(1) not in all_poetry_deps:
-                # Get the latest version that match the constraint
-                try:
-                    min_version = packaging.version.parse(match.group(2))
-                    max_version = packaging.version.parse(match.group(3))
-                    pypi_response = requests.get(f"https://pypi.org/pypi/{match.group(1)}/json", timeout=30)
-                    pypi_response.raise_for_status()
-                    package_info = pypi_response.json()
-                    releases = package_info.get("releases", {})
-                    valid_versions = [
-                        v
-                        for v in releases
-                        if packaging.version.parse(v) >= min_version
-                        and packaging.version.parse(v) < max_version
-                    ]
-                    valid_versions.sort(key=packaging.version.parse)
-                    if valid_versions:
-                        latest_version = valid_versions[-1]
-                        pyproject.setdefault("tool", {}).setdefault("poetry", {}).setdefault(
-                            "dependencies",
-                            {},
-                        )[match.group(1)] = latest_version
-                except requests.RequestException as e:
-                    print(f"Error fetching package info for {match.group(1)}: {e}")
-                except packaging.version.InvalidVersion as e:
-                    print(f"Invalid version for {match.group(1)}: {e}")
-                except Exception as e:  # pylint: disable=broad-except # noqa: BLE001
-                    print(f"Unexpected error for {match.group(1)}: {e}")
+                result.append(match)
+    return result
+
+
+_RELEASES_CACHE: dict[str, tuple[float, list[str]]] = {}
+# In seconds
+_RELEASES_CACHE_DURATION = 3600
+
+
+def _get_releases(package: str, network: _Network, cache_directory: Path | None = None) -> list[str]:
+    """Get the released versions of a package from PyPI, cached across the runs."""
+    cached = _RELEASES_CACHE.get(package)
+    if cached is not None and time.monotonic() - cached[0] < _RELEASES_CACHE_DURATION:
+        return cached[1]
+    releases = (
+        _fetch_releases(package, network)
+        if cache_directory is None
+        else _get_shared_releases(package, network, cache_directory)
+    )
+    _RELEASES_CACHE[package] = (time.monotonic(), releases)
+    return releases
+
+
+def _fetch_releases(package: str, network: _Network) -> list[str]:
+    return list(network.get(f"https://pypi.org/pypi/{package}/json").json().get("releases", {}))
+
+
+def _get_shared_releases(package: str, network: _Network, cache_directory: Path) -> list[str]:
+    """
+    Get the released versions of a package from the cache shared by the processes.
+
+    The cache file is not locked during the request, then the other processes are not blocked by
+    a slow network, and the last written versions are kept.
+    """
+    cache_directory.mkdir(parents=True, exist_ok=True)
+    cache_path = cache_directory / f"{package}.json"
+    cache_path.touch()
+    try:
+        cached = json.loads(_read_text(cache_path))
+        if time.time() - cached["time"] < _RELEASES_CACHE_DURATION and isinstance(cached["releases"], list):
+            releases: list[str] = cached["releases"]
+            return releases
+    except (json.JSONDecodeError, TypeError, KeyError):
+        # Empty or invalid cache file
+        pass
+    releases = _fetch_releases(package, network)
+    with _lock_files([cache_path]):
+        cache_path.write_text(json.dumps({"time": time.time(), "releases": releases}), encoding="utf-8")
+    return releases
+
+
+def _tweak_dependency_version(
+    pyproject: dict[str, Any] | mra.EditTOML,
+    network: _Network | None = None,
+    cache_directory: Path | None = None,
+) -> None:
+    """Tweak the dependency version in pyproject.toml."""
+
+    if network is None:
+        network = _get_default_run().network
+    for match in _get_poetry_add_dependencies(pyproject):
+        # Get the latest version that match the constraint
+        try:
+            min_version = packaging.version.parse(match.group(2))
+            max_version = packaging.version.parse(match.group(3))
+            releases = _get_releases(match.group(1), network, cache_directory)
+            valid_versions = [
+                v
+                for v in releases
+                if packaging.version.parse(v) >= min_version and packaging.version.parse(v) < max_version
+            ]
+            valid_versions.sort(key=packaging.version.parse)
+            if valid_versions:
+                latest_version = valid_versions[-1]
+                pyproject.setdefault("tool", {}).setdefault("poetry", {}).setdefault(
+                    "dependencies",
+                    {},
+                )[match.group(1)] = latest_version
+        except requests.RequestException as e:
+            print(f"Error fetching package info for {match.group(1)}: {e}")
+        except packaging.version.InvalidVersion as e:
+            print(f"Invalid version for {match.group(1)}: {e}")
+        except Exception as e:  # pylint: disable=broad-except # noqa: BLE001
+            print(f"Unexpected error for {match.group(1)}: {e}")
+
+    tweaked_dependencies = _get_tweaked_dependencies(pyproject)
+    if tweaked_dependencies is None:
+        return
+
+    for extra_name, dependencies in tweaked_dependencies.items():
+        if extra_name is None:
+            pyproject.setdefault("project", {})["dependencies"] = dependencies
+        else:
+            pyproject["project"].setdefault("optional-dependencies", {})[extra_name] = dependencies
+
 
+def _get_tweaked_dependencies(
+    pyproject: dict[str, Any] | mra.EditTOML,
+) -> dict[str | None, list[str]] | None:
+    """
+    Get the PEP 621 dependencies from the Poetry ones.
+
+    The key is the extra name, None for the main dependencies.
+    """
     plugin_config = pyproject.get("tool", {}).get("tweak-poetry-dependencies-versions")
     if plugin_config is None:
         plugin_config = pyproject.get("tool", {}).get(
             "poetry-plugin-tweak-dependencies-version",
         )
     if plugin_config is None:
-        return
+        return None
 
-    extras = pyproject.get("tool", {}).get("poetry", {}).get("extras", {})
-    new_dependencies = {}
-    for dependency_name, dependency_config in (
-        pyproject.get("tool", {}).get("poetry", {}).get("dependencies", {}).items()
-    ):
+    poetry = pyproject.get("tool", {}).get("poetry", {})
+    package_extras: dict[str, list[str]] = {}
+    for extra_name, packages in poetry.get("extras", {}).items():
+        for package in packages:
+            package_extras_names = package_extras.setdefault(package, [])
+            if extra_name not in package_extras_names:
+                package_extras_names.append(extra_name)
+
+    # The requirements to set by extra, computed once for each Poetry dependency
+    targets: dict[str | None, dict[str, str]] = {None: {}}
+    for dependency_name, dependency_config in poetry.get("dependencies", {}).items():
         if isinstance(dependency_config, str):
             dependency_config = {"version": dependency_config}  # noqa: PLW2901
 
+        extras_names: list[str | None] = [None]
+        if dependency_config.get("optional", False):
+            extras_names = list(package_extras.get(dependency_name, []))
+        for extra_name in extras_names:
+            targets.setdefault(extra_name, {})
+        if not extras_names or dependency_name == "python":
+            continue
+
         modifier = plugin_config.get(dependency_name)
         if modifier is None:
             modifier = plugin_config.get("default", "full")
-
-        new_version = {
-            "version": dependency_config.get("version"),
-            "in_extras": [],
-            "use_extras": dependency_config.get("extras", []),
-            "optional": dependency_config.get("optional", False),
-            "modifier": modifier,
-        }
-        if dependency_config.get("optional", False):
-            for extra_name, packages in extras.items():
-                if dependency_name in packages:
-                    new_version["in_extras"].append(extra_name)
-
-        new_dependencies[dependency_name] = new_version
-
-    all_extras = []
-    for dependency_config in new_dependencies.values():
-        all_extras.extend(dependency_config["in_extras"])
-
-    # Parse current dependencies
-    pyproject.setdefault("project", {})["dependencies"] = _replace_dependencies(
-        pyproject.get("project", {}).get("dependencies", []),
-        new_dependencies,
-        None,
-    )
-    for extra_name in all_extras:
-        pyproject["project"].setdefault("optional-dependencies", {})[extra_name] = _replace_dependencies(
-            pyproject.get("project", {}).get("optional-dependencies", {}).get(extra_name, []),
-            new_dependencies,
-            extra_name,
+        requirement = _get_tweaked_requirement(dependency_name, dependency_config, modifier)
+        if requirement is None:
+            continue
+        for extra_name in extras_names:
+            targets[extra_name][dependency_name] = requirement
+
+    project = pyproject.get("project", {})
+    result: dict[str | None, list[str]] = {}
+    for extra_name, requirements in targets.items():
+        current_dependencies = (
+            project.get("dependencies", [])
+            if extra_name is None
+            else project.get("optional-dependencies", {}).get(extra_name, [])
         )
+        dependencies = _get_requirements_index(current_dependencies)
+        dependencies.update(requirements)
+        result[extra_name] = list(dependencies.values())
+    return result
 
 
-def _replace_dependencies(
-    current_dependencies: list[str],
-    poetry_dependencies: dict[str, dict[str, Any]],
-    extra: str | None,
-) -> list[str]:
-    """Replace the dependencies in the pyproject.toml file."""
-    dependencies = {}
-    for dependency in current_dependencies:
+def _get_requirements_index(dependencies: list[str]) -> dict[str, str]:
+    """Get the normalized requirements by package name."""
+    index = {}
+    for dependency in dependencies:
         requirement = packaging.requirements.Requirement(dependency)
-        dependencies[requirement.name] = requirement
-
-    for dependency_name, dependency_config in poetry_dependencies.items():
-        if extra is None and dependency_config["optional"]:
-            continue
-        if extra is not None and extra not in dependency_config["in_extras"]:
-            continue
-        if dependency_name == "python":
-            # Skip python dependency
-            continue
-        requirement = packaging.requirements.Requirement(dependency_name)
-        requirement.extras = dependency_config["use_extras"]
-        if dependency_config["modifier"] in ["major", "minor", "patch"]:
-            try:
-                version_split = [int(part) for part in dependency_config["version"].split(".")]
-            except ValueError:
-                # If the version is not a valid version, skip it
-                print(
-                    "Warning: Invalid version for dependency %s: %s",
-                    dependency_name,
-                    dependency_config["version"],
-                )
-                continue
-
-            version_min = None
-            version_max = None
-            if dependency_config["modifier"] == "major":
-                version_min = [version_split[0]]
-                version_max = [version_split[0] + 1]
-            elif dependency_config["modifier"] == "minor":
-                version_min = version_split[0:2]
-                if len(version_min) == 2:
-                    version_max = [version_min[0], version_min[1] + 1]
-                else:
-                    version_min = version_split
-                    version_max = version_split
-            elif dependency_config["modifier"] == "patch":
-                version_min = version_split[0:3]
-                if len(version_min) == 3:
-                    version_max = [
-                        version_min[0],
-                        version_min[1],
-                        version_min[2] + 1,
-                    ]
-                else:
-                    version_max = version_min
-            if version_min is not None and version_max is not None:
-                if version_min == version_max:
-                    requirement.specifier = packaging.specifiers.SpecifierSet(
-                        f"== {'.'.join(map(str, version_min))}",
-                    )
-                else:
-                    requirement.specifier = packaging.specifiers.SpecifierSet(
-                        f">={'.'.join(map(str, version_min))},<{'.'.join(map(str, version_max))}",
-                    )
-        elif dependency_config["modifier"] == "full":
-            version = dependency_config["version"]
-            requirement.specifier = packaging.specifiers.SpecifierSet(
-                f"== {version}",
-            )
-        elif dependency_config["modifier"] != "present":
-            version = dependency_config["modifier"]
-            requirement.specifier = packaging.specifiers.SpecifierSet(
-                version,
+        index[requirement.name] = str(requirement)
+    return index
+
+
+def _get_tweaked_requirement(
+    dependency_name: str,
+    dependency_config: dict[str, Any],
+    modifier: str,
+) -> str | None:
+    """Get the PEP 508 requirement of a Poetry dependency, None if the version is invalid."""
+    requirement = packaging.requirements.Requirement(dependency_name)
+    requirement.extras = dependency_config.get("extras", [])
+    if modifier in ["major", "minor", "patch"]:
+        try:
+            version_split = [int(part) for part in dependency_config["version"].split(".")]
+        except ValueError:
+            # If the version is not a valid version, skip it
+            print(
+                "Warning: Invalid version for dependency %s: %s",
+                dependency_name,
+                dependency_config["version"],
             )
+            return None
 
-        dependencies[dependency_name] = requirement
+        version_min = None
+        version_max = None
+        if modifier == "major":
+            version_min = [version_split[0]]
+            version_max = [version_split[0] + 1]
+        elif modifier == "minor":
+            version_min = version_split[0:2]
+            if len(version_min) == 2:
+                version_max = [version_min[0], version_min[1] + 1]
+            else:
+                version_min = version_split
+                version_max = version_split
+        elif modifier == "patch":
+            version_min = version_split[0:3]
+            if len(version_min) == 3:
+                version_max = [
+                    version_min[0],
+                    version_min[1],
+                    version_min[2] + 1,
+                ]
+            else:
+                version_max = version_min
+        if version_min is not None and version_max is not None:
+            if version_min == version_max:
+                requirement.specifier = packaging.specifiers.SpecifierSet(
+                    f"== {'.'.join(map(str, version_min))}",
+                )
+            else:
+                requirement.specifier = packaging.specifiers.SpecifierSet(
+                    f">={'.'.join(map(str, version_min))},<{'.'.join(map(str, version_max))}",
+                )
+    elif modifier == "full":
+        requirement.specifier = packaging.specifiers.SpecifierSet(
+            f"== {dependency_config['version']}",
+        )
+    elif modifier != "present":
+        requirement.specifier = packaging.specifiers.SpecifierSet(modifier)
 
-    return [str(requirement) for requirement in dependencies.values()]
+    return str(requirement)
@@ -0,0 +1,137 @@
+# Copyright (c) 2026, Stéphane Brunner
+
+"""
+Pytest suite for the discovery of the directories.
+"""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from python_versions_hook import _get_all_directories, _GlobTrie
+
+
+@pytest.fixture
+def root(tmp_path: Path) -> Path:
+    for directory in (
+        ".git/objects",
+        "src/pkg/__pycache__",
+        "src/pkg/node_modules/dep",
+        "tests/test_data/project",
+        "tests/unit",
+        "vendor/lib",
+    ):
+        (tmp_path / directory).mkdir(parents=True)
+    return tmp_path
+
+
+def _relative(root: Path, directories: list[Path]) -> list[str]:
+    return [directory.relative_to(root).as_posix() for directory in directories]
+
+
+@pytest.mark.parametrize(
+    ("pattern", "path", "expected"),
+    [
+        ("vendor", "vendor", True),
+        ("vendor", "vendor/lib", True),
+        ("vendor", "src/vendor", False),
+        ("**/node_modules", "node_modules", True),
+        ("**/node_modules", "src/pkg/node_modules/dep", True),
+        ("tests/test_*", "tests/test_data", True),
+        ("tests/test_*", "tests/unit", False),
+        ("./src/*/data/", "src/pkg/data", True),
+        ("src/**/data", "src/data", True),
+        ("src/**/data", "src/a/b/data", True),
+    ],
+)
+def test_glob_trie(pattern: str, path: str, expected: bool) -> None:
+    trie = _GlobTrie([pattern])
+    state = trie.start()
+    matches = False
+    for name in path.split("/"):
+        state = trie.step(state, name)
+        matches = matches or trie.matches(state)
+    assert matches == expected
+
+
+@pytest.mark.parametrize(
+    ("patterns", "path", "expected"),
+    [
+        (["a/b", "**/c"], "a/b", True),
+        (["a/b", "**/c"], "x/a/b", False),
+        (["a/b", "**/c"], "x/a/c", True),
+        (["a/c", "a/**/zzz"], "a/x/c", False),
+        (["a/c", "a/**/zzz"], "a/x/y/zzz", True),
+        (["vendor", "**/node_modules"], "src/vendor", False),
+        (["**/node_modules", "build"], "src/build", False),
+        (["**/node_modules", "build"], "build", True),
+        (["a/**/b/**/c", "a/*/d"], "a/x/b/y/z/c", True),
+        (["a/**/b/**/c", "a/*/d"], "a/x/y/d", False),
+    ],
+)
+def test_glob_trie_patterns(patterns: list[str], path: str, expected: bool) -> None:
+    trie = _GlobTrie(patterns)
+    state = trie.start()
+    matches = False
+    for name in path.split("/"):
+        state = trie.step(state, name)
+        matches = matches or trie.matches(state)
+    assert matches == expected
+
+
+def test_get_all_directories(root: Path) -> None:
+    assert _relative(root, _get_all_directories(root)) == [
+        "src",
+        "src/pkg",
+        "src/pkg/node_modules",
+        "src/pkg/node_modules/dep",
+        "tests",
+        "tests/test_data",
+        "tests/test_data/project",
+        "tests/unit",
+        "vendor",
+        "vendor/lib",
+    ]
+
+
+def test_get_all_directories_exclude(root: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    scanned = []
+    scandir = os.scandir
+
+    def scandir_spy(path):
+        scanned.append(Path(path).relative_to(root).as_posix())
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", scandir_spy)
+
+    assert _relative(
+        root, _get_all_directories(root, exclude=["vendor", "**/node_modules", "tests/test_*"])
+    ) == [
+        "src",
+        "src/pkg",
+        "tests",
+        "tests/unit",
+    ]
+    # The excluded directories are not walked
+    assert scanned == [".", "src", "src/pkg", "tests", "tests/unit"]
+
+
+def test_get_all_directories_exclude_anchored(root: Path) -> None:
+    (root / "src" / "vendor").mkdir()
+
+    assert _relative(root, _get_all_directories(root, exclude=["vendor", "**/node_modules"])) == [
+        "src",
+        "src/pkg",
+        "src/vendor",
+        "tests",
+        "tests/test_data",
+        "tests/test_data/project",
+        "tests/unit",
+    ]
+
+
+def test_get_all_directories_include(root: Path) -> None:
+    assert _relative(root, _get_all_directories(root, include=["src/*"], exclude=["**/node_modules"])) == [
+        "src/pkg",
+    ]
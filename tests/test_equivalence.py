@@ -0,0 +1,616 @@
+# Copyright (c) 2026, Stéphane Brunner
+
+"""
+Differential test between the reference implementation and the optimized one.
+
+The reference implementation is a frozen copy of the sequential engine, that updates the directories
+one after the other with the full round-trip editors, the optimized one patches the values in place
+and updates the directories in parallel. Only the discovery of the directories and the detection of
+the Python versions are shared. Both are run on copies of randomly generated repositories, and should
+give the same files.
+"""
+
+import random
+import shutil
+from pathlib import Path
+from typing import Any
+
+import multi_repo_automation as mra
+import packaging.requirements
+import packaging.specifiers
+import packaging.version
+import pytest
+import tomlkit
+
+import python_versions_hook
+from python_versions_hook import (
+    _detect_python_version,
+    _get_all_directories,
+    _get_python_specifiers_version_from_config,
+    _get_python_version,
+    _get_tox_envlist,
+    _natural_sort_key,
+    _split_tox_envlist,
+    sync_python_versions,
+)
+
+_MINORS = range(6, 15)
+
+
+# The package versions returned by PyPI
+_RELEASES = {
+    "pkg_d": ["1.0.0", "1.4.2", "1.10.0", "2.0.0", "2.1.0rc1"],
+    "pkg-e": ["0.1", "0.2.1", "1.0"],
+}
+
+
+def _version(rand: random.Random) -> str:
+    return f"3.{rand.choice(_MINORS)}"
+
+
+def _specifier(rand: random.Random) -> str:
+    minor = rand.choice(_MINORS)
+    return rand.choice(
+        [
+            f">=3.{minor}",
+            f">=3.{minor},<4",
+            f">=3.{minor},<3.{minor + 3}",
+            f"^3.{minor}",
+            f">3.{minor}.1",
+            f"==3.{minor}.*",
+            f">=3.{minor + 10}",
+        ],
+    )
+
+
+def _string(rand: random.Random, value: str) -> str:
+    return rand.choice([f'"{value}"', f"'{value}'"])
+
+
+def _pyproject(rand: random.Random) -> str:
+    poetry = rand.random() < 0.5
+    lines = ["# Generated", ""]
+
+    # In the [tool] table, as dotted keys or inline tables
+    tool_lines = []
+    if rand.random() < 0.2:
+        tool_lines += [
+            rand.choice(
+                [
+                    f'ruff = {{ target-version = "py{_version(rand).replace(".", "")}", line-length = 110 }}',
+                    f'ruff.target-version = "py{_version(rand).replace(".", "")}"',
+                ]
+            )
+        ]
+    if rand.random() < 0.2:
+        tool_lines += [f"mypy = {{ python_version = {_string(rand, _version(rand))}, strict = true }}"]
+    if tool_lines:
+        lines += ["[tool]", *tool_lines, ""]
+
+    if rand.random() < 0.5 and not any(line.startswith("mypy") for line in tool_lines):
+        lines += ["[tool.mypy]", f"python_version = {_string(rand, _version(rand))}  # comment", ""]
+    if rand.random() < 0.3:
+        version = _version(rand).replace(".", "")
+        lines += [
+            "[tool.black]",
+            rand.choice([f'target-version = ["py{version}"]', f"target-version = [\n  'py{version}',\n]"]),
+            "",
+        ]
+    if rand.random() < 0.5 and not any(line.startswith("ruff") for line in tool_lines):
+        lines += [
+            "[tool.ruff]",
+            f'target-version = "py{_version(rand).replace(".", "")}"',
+            "line-length = 110",
+            "",
+        ]
+    if rand.random() < 0.2:
+        lines += [
+            "[tool.python-versions-hook]",
+            f"keep-requires-python = {rand.choice(['true', 'false'])}",
+            "",
+        ]
+
+    classifiers = [
+        f"Programming Language :: Python :: {_version(rand)}",
+        "Typing :: Typed",
+        "Programming Language :: Python",
+    ]
+    rand.shuffle(classifiers)
+    classifiers_lines = (
+        rand.choice(
+            [
+                [f"classifiers = [{', '.join(_string(rand, c) for c in classifiers)}]"],
+                ["classifiers = [", *[f"    {_string(rand, c)}," for c in classifiers], "]"],
+            ],
+        )
+        if rand.random() < 0.7
+        else []
+    )
+
+    dependencies = {
+        "pkg_a": "1.2.3",
+        "pkg_b": "2.0",
+        "pkg_c": "3.4.5",
+    }
+    optional = rand.random() < 0.5
+    if poetry:
+        lines += ["[tool.poetry]"]
+        if rand.random() < 0.5:
+            lines += classifiers_lines
+        lines += ["", "[tool.poetry.dependencies]", f"python = {_string(rand, _specifier(rand))}"]
+        lines += [
+            (
+                f'{name} = {{ version = "{version}", extras = ["extra"] }}'
+                if rand.random() < 0.2
+                else f"{name} = {_string(rand, version)}"
+            )
+            for name, version in dependencies.items()
+        ]
+        if optional:
+            lines += ['pkg_opt = { version = "1.0.0", optional = true }', "", "[tool.poetry.extras]"]
+            lines += ['extra1 = ["pkg_opt"]', 'extra2 = ["pkg_opt"]']
+        lines += [""]
+        if rand.random() < 0.7:
+            lines += [
+                "[tool.tweak-poetry-dependencies-versions]",
+                f"default = {_string(rand, rand.choice(['present', 'major', 'minor', 'patch', 'full']))}",
+                f'pkg_b = "{rand.choice(["present", "full", ">=2,<3"])}"',
+                "",
+            ]
+
+    if rand.random() < 0.8 or not poetry:
+        lines += ["[project]", 'name = "test"']
+        if not poetry or rand.random() < 0.5:
+            lines += [f"requires-python = {_string(rand, _specifier(rand).replace('^', '>='))}"]
+        if not any(line.startswith("classifiers") for line in lines):
+            lines += classifiers_lines
+        if poetry and rand.random() < 0.5:
+            current = [f"{name}=={version}" for name, version in dependencies.items()]
+            if rand.random() < 0.5:
+                # Added with `poetry add`
+                current += rand.sample(["pkg_d (>=1.0.0,<2.0.0)", "pkg-e (>=0.2,<1.0)"], rand.randint(1, 2))
+            rand.shuffle(current)
+            lines += [
+                rand.choice(
+                    [f'dependencies = ["{current[0]}"]', f"dependencies = {current}".replace("'", '"')]
+                )
+            ]
+            if optional and rand.random() < 0.5:
+                lines += ["", "[project.optional-dependencies]", 'extra1 = ["pkg_opt==0.1"]']
+        lines += [""]
+    return "\n".join(lines)
+
+
+def _hook_regex(rand: random.Random) -> list[str]:
+    key = rand.choice(["files", "exclude"])
+    return rand.choice(
+        [
+            [],
+            [f"        {key}: ^src/"],
+            [f"        {key}: '^(tests|docs)/'"],
+            [f"        {key}: ^({'|'.join(f'directory{index}' for index in range(10))})/"],
+            [f"        {key}: (?x)^(src|tests)/"],
+            [f"        {key}: |", "          (?x)^(", "            tests/.*", "          )$"],
+        ],
+    )
+
+
+def _pre_commit_config(rand: random.Random) -> str:
+    lines = []
+    if rand.random() < 0.3:
+        lines += ["ci:", "  skip:", "    - pyupgrade"]
+    if rand.random() < 0.5:
+        lines += ["default_language_version:", f"  python: '{_version(rand)}'"]
+    lines += ["repos:"]
+    repositories = [
+        [
+            "  - repo: https://github.com/pre-commit/pre-commit-hooks",
+            "    rev: v5.0.0",
+            "    hooks:",
+            "      - id: check-yaml",
+            *_hook_regex(rand),
+        ],
+        [
+            "  - repo: https://github.com/asottile/pyupgrade",
+            "    rev: v3.19.0",
+            "    hooks:",
+            "      - id: pyupgrade",
+            *(
+                ["        args:", f"          - --py{_version(rand).replace('.', '')}-plus"]
+                if rand.random() < 0.8
+                else []
+            ),
+            *_hook_regex(rand),
+        ],
+    ]
+    rand.shuffle(repositories)
+    for repository in repositories:
+        lines += repository
+    return "\n".join(lines) + "\n"
+
+
+def _prospector(rand: random.Random) -> str:
+    lines = ["inherits:", "  - utils:base"]
+    if rand.random() < 0.8:
+        lines += ["mypy:", "  options:", f"    python-version: '{_version(rand)}'"]
+    if rand.random() < 0.8:
+        lines += ["ruff:", "  options:", f"    target-version: py{_version(rand).replace('.', '')}"]
+    return "\n".join(lines) + "\n"
+
+
+def _jsonschema_gentypes(rand: random.Random) -> str:
+    lines = ["headers: |", "  # Automatically generated file"]
+    if rand.random() < 0.8:
+        lines += [f"python_version: '{_version(rand)}'"]
+    return "\n".join(lines) + "\n"
+
+
+_FILES = {
+    "pyproject.toml": _pyproject,
+    ".python-version": lambda rand: rand.choice([_version(rand), f"{_version(rand)}.2", "system"]) + "\n",
+    ".pre-commit-config.yaml": _pre_commit_config,
+    ".prospector.yaml": _prospector,
+    "jsonschema-gentypes.yaml": _jsonschema_gentypes,
+    "tox.ini": lambda rand: f"[tox]\nenvlist = py{_version(rand).replace('.', '')}, lint\n",
+}
+
+
+def _generate_repository(rand: random.Random, directory: Path, depth: int = 0) -> None:
+    for name, generator in _FILES.items():
+        if rand.random() < 0.4:
+            (directory / name).write_text(generator(rand))
+    if depth < 3:
+        for index in range(rand.randint(0, 3 - depth)):
+            subdirectory = directory / f"dir{index}"
+            subdirectory.mkdir()
+            _generate_repository(rand, subdirectory, depth + 1)
+
+
+def _files(root: Path, recursive: bool = True) -> dict[str, bytes]:
+    return {
+        str(path.relative_to(root)): path.read_bytes()
+        for path in sorted(root.rglob("*") if recursive else root.iterdir())
+        if path.is_file()
+    }
+
+
+def _reference_edit(editor_class: Any, path: Path) -> Any:
+    return editor_class(path, run_pre_commit=False, add_pre_commit_configuration_if_modified=False)
+
+
+def _reference_tweak_dependency_version(pyproject: mra.EditTOML) -> None:
+    """Tweak the dependency version in pyproject.toml."""
+
+    all_poetry_deps = set(pyproject.get("tool", {}).get("poetry", {}).get("dependencies", {}).keys())
+    for group_deps in pyproject.get("tool", {}).get("poetry", {}).get("group", {}).values():
+        if isinstance(group_deps, dict):
+            all_poetry_deps.update(group_deps.get("dependencies", {}).keys())
+
+    current_project_dependencies = pyproject.get("project", {}).get("dependencies", [])
+    for full_dependencies in current_project_dependencies:
+        if isinstance(full_dependencies, str):
+            match = python_versions_hook._POETRY_ADD_PACKAGE_REGEX.match(full_dependencies)
+            if match and match.group(1) not in all_poetry_deps:
+                # Get the latest version that match the constraint
+                min_version = packaging.version.parse(match.group(2))
+                max_version = packaging.version.parse(match.group(3))
+                valid_versions = [
+                    v
+                    for v in _RELEASES[match.group(1)]
+                    if packaging.version.parse(v) >= min_version and packaging.version.parse(v) < max_version
+                ]
+                valid_versions.sort(key=packaging.version.parse)
+                if valid_versions:
+                    latest_version = valid_versions[-1]
+                    pyproject.setdefault("tool", {}).setdefault("poetry", {}).setdefault(
+                        "dependencies",
+                        {},
+                    )[match.group(1)] = latest_version
+
+    plugin_config = pyproject.get("tool", {}).get("tweak-poetry-dependencies-versions")
+    if plugin_config is None:
+        plugin_config = pyproject.get("tool", {}).get(
+            "poetry-plugin-tweak-dependencies-version",
+        )
+    if plugin_config is None:
+        return
+
+    extras = pyproject.get("tool", {}).get("poetry", {}).get("extras", {})
+    new_dependencies = {}
+    for dependency_name, dependency_config in (
+        pyproject.get("tool", {}).get("poetry", {}).get("dependencies", {}).items()
+    ):
+        if isinstance(dependency_config, str):
+            dependency_config = {"version": dependency_config}  # noqa: PLW2901
+
+        modifier = plugin_config.get(dependency_name)
+        if modifier is None:
+            modifier = plugin_config.get("default", "full")
+
+        new_version = {
+            "version": dependency_config.get("version"),
+            "in_extras": [],
+            "use_extras": dependency_config.get("extras", []),
+            "optional": dependency_config.get("optional", False),
+            "modifier": modifier,
+        }
+        if dependency_config.get("optional", False):
+            for extra_name, packages in extras.items():
+                if dependency_name in packages:
+                    new_version["in_extras"].append(extra_name)
+
+        new_dependencies[dependency_name] = new_version
+
+    all_extras = []
+    for dependency_config in new_dependencies.values():
+        all_extras.extend(dependency_config["in_extras"])
+
+    pyproject.setdefault("project", {})["dependencies"] = _reference_replace_dependencies(
+        pyproject.get("project", {}).get("dependencies", []),
+        new_dependencies,
+        None,
+    )
+    for extra_name in all_extras:
+        pyproject["project"].setdefault("optional-dependencies", {})[extra_name] = (
+            _reference_replace_dependencies(
+                pyproject.get("project", {}).get("optional-dependencies", {}).get(extra_name, []),
+                new_dependencies,
+                extra_name,
+            )
+        )
+
+
+def _reference_replace_dependencies(
+    current_dependencies: list[str],
+    poetry_dependencies: dict[str, dict[str, Any]],
+    extra: str | None,
+) -> list[str]:
+    """Replace the dependencies in the pyproject.toml file."""
+    dependencies = {}
+    for dependency in current_dependencies:
+        requirement = packaging.requirements.Requirement(dependency)
+        dependencies[requirement.name] = requirement
+
+    for dependency_name, dependency_config in poetry_dependencies.items():
+        if extra is None and dependency_config["optional"]:
+            continue
+        if extra is not None and extra not in dependency_config["in_extras"]:
+            continue
+        if dependency_name == "python":
+            continue
+        requirement = packaging.requirements.Requirement(dependency_name)
+        requirement.extras = dependency_config["use_extras"]
+        if dependency_config["modifier"] in ["major", "minor", "patch"]:
+            try:
+                version_split = [int(part) for part in dependency_config["version"].split(".")]
+            except ValueError:
+                continue
+
+            version_min = None
+            version_max = None
+            if dependency_config["modifier"] == "major":
+                version_min = [version_split[0]]
+                version_max = [version_split[0] + 1]
+            elif dependency_config["modifier"] == "minor":
+                version_min = version_split[0:2]
+                if len(version_min) == 2:
+                    version_max = [version_min[0], version_min[1] + 1]
+                else:
+                    version_min = version_split
+                    version_max = version_split
+            elif dependency_config["modifier"] == "patch":
+                version_min = version_split[0:3]
+                if len(version_min) == 3:
+                    version_max = [version_min[0], version_min[1], version_min[2] + 1]
+                else:
+                    version_max = version_min
+            if version_min is not None and version_max is not None:
+                if version_min == version_max:
+                    requirement.specifier = packaging.specifiers.SpecifierSet(
+                        f"== {'.'.join(map(str, version_min))}",
+                    )
+                else:
+                    requirement.specifier = packaging.specifiers.SpecifierSet(
+                        f">={'.'.join(map(str, version_min))},<{'.'.join(map(str, version_max))}",
+                    )
+        elif dependency_config["modifier"] == "full":
+            requirement.specifier = packaging.specifiers.SpecifierSet(f"== {dependency_config['version']}")
+        elif dependency_config["modifier"] != "present":
+            requirement.specifier = packaging.specifiers.SpecifierSet(dependency_config["modifier"])
+
+        dependencies[dependency_name] = requirement
+
+    return [str(requirement) for requirement in dependencies.values()]
+
+
+def _reference_update_files_in_directory(
+    directory: Path,
+    minimal_version: packaging.version.Version,
+    all_version: list[packaging.version.Version],
+) -> None:
+    """Update the files of a directory with the full round-trip editors."""
+    # In pyproject.toml
+    pyproject_path = directory / "pyproject.toml"
+    if pyproject_path.exists():
+        with _reference_edit(mra.EditTOML, pyproject_path) as pyproject:
+            if "python_version" in pyproject.get("tool", {}).get("mypy", {}):
+                pyproject["tool"]["mypy"]["python_version"] = str(minimal_version)
+
+            if "target-version" in pyproject.get("tool", {}).get("black", {}):
+                pyproject["tool"]["black"]["target-version"] = [
+                    f"py{minimal_version.major}{minimal_version.minor}",
+                ]
+
+            if "target-version" in pyproject.get("tool", {}).get("ruff", {}):
+                pyproject["tool"]["ruff"]["target-version"] = (
+                    f"py{minimal_version.major}{minimal_version.minor}"
+                )
+
+            version_set = _get_python_specifiers_version_from_config(pyproject)
+            if version_set is None:
+                return
+
+            classifiers_version = [version for version in all_version if version_set.contains(version)]
+
+            config = pyproject.get("tool", {}).get("python-versions-hook", {})
+            keep_requires_python = config.get("keep-requires-python", False)
+            if not keep_requires_python and "project" in pyproject:
+                pyproject["project"]["requires-python"] = f">={minimal_version}"
+
+            has_poetry_classifiers = False
+            if "classifiers" in pyproject.get("project", {}):
+                classifiers = pyproject["project"]["classifiers"]
+            elif "classifiers" in pyproject.get("tool", {}).get("poetry", {}) and "python" in pyproject.get(
+                "tool", {}
+            ).get("poetry", {}).get("dependencies", {}):
+                has_poetry_classifiers = True
+                classifiers = pyproject["tool"]["poetry"]["classifiers"]
+            else:
+                return
+
+            classifiers = [c for c in classifiers if not c.startswith("Programming Language :: Python")]
+            classifiers.append("Programming Language :: Python")
+            classifiers.append("Programming Language :: Python :: 3")
+            for current_version in classifiers_version:
+                classifiers.append(f"Programming Language :: Python :: {current_version}")
+
+            classifier_item = tomlkit.array(
+                sorted(classifiers, key=_natural_sort_key),  # type: ignore[arg-type]
+            ).multiline(multiline=True)
+            if has_poetry_classifiers:
+                pyproject["tool"]["poetry"]["classifiers"] = classifier_item
+            else:
+                pyproject["project"]["classifiers"] = classifier_item
+
+            _reference_tweak_dependency_version(pyproject)
+
+    # In .pre-commit-config.yaml (local)
+    pre_commit_config_path = directory / ".pre-commit-config.yaml"
+    if pre_commit_config_path.exists():
+        with _reference_edit(mra.EditPreCommitConfig, pre_commit_config_path) as pre_commit:
+            if "python" in pre_commit.get("default_language_version", {}):
+                pre_commit["default_language_version"]["python"] = (
+                    f"{minimal_version.major}.{minimal_version.minor}"
+                )
+
+            if "https://github.com/asottile/pyupgrade" in pre_commit.repos_hooks:
+                pre_commit.repos_hooks["https://github.com/asottile/pyupgrade"]["repo"]["hooks"][0][
+                    "args"
+                ] = [
+                    (f"--py{minimal_version.major}{minimal_version.minor}-plus"),
+                ]
+
+    # In .python-version (local)
+    python_version_path = directory / ".python-version"
+    if python_version_path.exists():
+        python_version_path.write_text(f"{minimal_version.major}.{minimal_version.minor}\n")
+
+    # In all .prospector.yaml files (local)
+    for prospector_path in directory.glob("*.prospector.yaml"):
+        with _reference_edit(mra.EditYAML, prospector_path) as yaml:
+            yaml.setdefault("mypy", {}).setdefault("options", {})["python-version"] = (
+                f"{minimal_version.major}.{minimal_version.minor}"
+            )
+            yaml.setdefault("ruff", {}).setdefault("options", {})["target-version"] = (
+                f"py{minimal_version.major}{minimal_version.minor}"
+            )
+
+    # In jsonschema-gentypes.yaml (local)
+    jsonschema_gentypes_path = directory / "jsonschema-gentypes.yaml"
+    if jsonschema_gentypes_path.exists():
+        with _reference_edit(mra.EditYAML, jsonschema_gentypes_path) as yaml:
+            yaml["python_version"] = f"{minimal_version.major}.{minimal_version.minor}"
+
+    # In the GitHub workflows matrix
+    if directory.parts[-2:] == (".github", "workflows"):
+        python_versions = [f"{version.major}.{version.minor}" for version in all_version]
+        for workflow_path in sorted([*directory.glob("*.yaml"), *directory.glob("*.yml")]):
+            with _reference_edit(mra.EditYAML, workflow_path) as workflow:
+                for job in workflow.get("jobs", {}).values():
+                    matrix = job.get("strategy", {}).get("matrix", {})
+                    if [str(version) for version in matrix.get("python-version", [])] != python_versions:
+                        matrix["python-version"] = python_versions
+
+    # In tox.ini (local)
+    tox_path = directory / "tox.ini"
+    if tox_path.exists():
+        with _reference_edit(mra.EditConfig, tox_path) as tox:
+            envlist = _split_tox_envlist(tox["tox"]["envlist"].value)
+            new_envlist = _get_tox_envlist(envlist, all_version)
+            if new_envlist != envlist:
+                tox["tox"]["envlist"].value = ", ".join(new_envlist)
+
+
+def _reference_sync_python_versions(
+    root: Path,
+) -> list[tuple[str, packaging.version.Version, list[packaging.version.Version], list[str]]]:
+    """Update the directories one after the other, get the versions and the changed files by directory."""
+    result = []
+    for directory in _get_all_directories(root):
+        version = _detect_python_version(directory, root)
+        if version is None:
+            continue
+
+        first_version, last_version = _get_python_version(directory)
+        if isinstance(version, packaging.specifiers.SpecifierSet):
+            all_version = [
+                packaging.version.Version(f"{first_version.major}.{minor}")
+                for minor in range(first_version.minor, last_version.minor + 1)
+                if version.contains(packaging.version.Version(f"{first_version.major}.{minor}"))
+            ]
+            if not all_version:
+                continue
+            minimal_version = all_version[0]
+        else:
+            minimal_version = version
+            all_version = [packaging.version.Version(f"{version.major}.{version.minor}")]
+
+        before = _files(directory, recursive=False)
+        _reference_update_files_in_directory(directory, minimal_version, all_version)
+        after = _files(directory, recursive=False)
+        result.append(
+            (
+                str(directory.relative_to(root)),
+                minimal_version,
+                all_version,
+                sorted(
+                    str((directory / name).relative_to(root))
+                    for name in after
+                    if before.get(name) != after[name]
+                ),
+            ),
+        )
+    return result
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_equivalence(seed: int, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    rand = random.Random(seed)  # noqa: S311 # nosec
+    original = tmp_path / "original"
+    original.mkdir()
+    _generate_repository(rand, original)
+    workflows = original / ".github" / "workflows"
+    workflows.mkdir(parents=True)
+    (workflows / "main.yaml").write_text(
+        f"jobs:\n  test:\n    strategy:\n      matrix:\n        python-version:\n          - '{_version(rand)}'\n",
+    )
+    reference_root = tmp_path / "reference"
+    optimized_root = tmp_path / "optimized"
+    shutil.copytree(original, reference_root)
+    shutil.copytree(original, optimized_root)
+
+    monkeypatch.setattr(python_versions_hook, "_get_releases", lambda package, *_: _RELEASES[package])
+
+    optimized = sync_python_versions(optimized_root, jobs=4)
+    reference = _reference_sync_python_versions(reference_root)
+
+    assert _files(optimized_root) == _files(reference_root)
+    assert reference == [
+        (
+            str(directory.directory.relative_to(optimized_root)),
+            directory.minimal_version,
+            directory.supported_versions,
+            sorted(str(file.relative_to(optimized_root)) for file in directory.changed_files),
+        )
+        for directory in optimized.directories
+    ]
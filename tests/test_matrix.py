@@ -0,0 +1,99 @@
+# Copyright (c) 2026, Stéphane Brunner
+
+"""
+Pytest suite for the CI matrix generation.
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import packaging.version
+import pytest
+
+from python_versions_hook import _get_tox_envlist, _split_tox_envlist, _update_files_in_directory, main
+
+_SUPPORTED_VERSIONS = [packaging.version.Version("3.11"), packaging.version.Version("3.12")]
+
+
+@pytest.mark.parametrize(
+    ("envlist", "expected"),
+    [
+        ("py39, py310, lint", ["py311", "py312", "lint"]),
+        ("lint,py{39,310}-django,py{39,310}", ["lint", "py{311,312}-django", "py{311,312}"]),
+        ("py39-lint, py310-lint, py39", ["py311-lint", "py312-lint", "py311", "py312"]),
+        ("django-py39, py39-django", ["django-py311", "django-py312", "py311-django", "py312-django"]),
+        ("{py39,py310}-django", ["{py311,py312}-django"]),
+        (
+            "py{39,310}-django{40,41}, python-lint, pypy3",
+            ["py{311,312}-django{40,41}", "python-lint", "pypy3"],
+        ),
+        ("\npy39\npy310\n", ["py311", "py312"]),
+        ("lint", ["lint"]),
+    ],
+)
+def test_get_tox_envlist(envlist: str, expected: list[str]) -> None:
+    assert _get_tox_envlist(_split_tox_envlist(envlist), _SUPPORTED_VERSIONS) == expected
+
+
+def test_update_files_in_directory_ci(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    workflows = tmp_path / ".github" / "workflows"
+    workflows.mkdir(parents=True)
+    (workflows / "main.yaml").write_text("""jobs:
+  test:
+    runs-on: ubuntu-24.04
+    strategy:
+      matrix:
+        python-version:
+          - '3.9'
+          - '3.10'
+          - '3.11'
+  dynamic:
+    strategy:
+      matrix:
+        python-version: ${{ fromJSON(needs.matrix.outputs.python) }}
+""")
+    (tmp_path / "tox.ini").write_text("[tox]\nenvlist = py39, py310, lint\n")
+
+    for directory in (Path(".github/workflows"), Path()):
+        _update_files_in_directory(
+            directory,
+            packaging.version.Version("3.11"),
+            packaging.version.Version("3.0"),
+            packaging.version.Version("3.12"),
+            supported_versions=_SUPPORTED_VERSIONS,
+        )
+
+    assert (
+        (workflows / "main.yaml").read_text()
+        == """jobs:
+  test:
+    runs-on: ubuntu-24.04
+    strategy:
+      matrix:
+        python-version:
+          - '3.11'
+          - '3.12'
+  dynamic:
+    strategy:
+      matrix:
+        python-version: ${{ fromJSON(needs.matrix.outputs.python) }}
+"""
+    )
+    assert (tmp_path / "tox.ini").read_text() == "[tox]\nenvlist = py311, py312, lint\n"
+
+
+def test_matrix(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "pyproject.toml").write_text('[project]\nrequires-python = ">=3.12"\n')
+    (tmp_path / ".python-version").write_text("3.13\n")
+    monkeypatch.setattr(sys, "argv", ["python-versions-hook", "--matrix"])
+
+    main()
+
+    assert json.loads(capsys.readouterr().out) == {"python-version": ["3.12", "3.13"]}
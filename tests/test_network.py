@@ -0,0 +1,91 @@
+# Copyright (c) 2026, Stéphane Brunner
+
+"""
+Pytest suite for the network access with bounded latency.
+"""
+
+import time
+
+import pytest
+import requests
+
+from python_versions_hook import _DirectoryUpdate, _Network, _NetworkUnavailableError
+
+
+class _Session(requests.Session):
+    def __init__(self, responses: list[int | Exception]) -> None:
+        super().__init__()
+        self.responses = responses
+        self.calls = 0
+
+    def get(self, url, **kwargs):  # type: ignore[override]
+        self.calls += 1
+        status = self.responses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        response = requests.Response()
+        response.status_code = status
+        response.url = url
+        return response
+
+
+def test_circuit_breaker() -> None:
+    session = _Session([requests.ConnectionError() for _ in range(3)])
+    network = _Network(max_failures=2, session=session)
+
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            network.get("https://pypi.org/pypi/test/json")
+    with pytest.raises(_NetworkUnavailableError):
+        network.get("https://pypi.org/pypi/test/json")
+    assert session.calls == 2
+
+
+def test_budget_exhausted() -> None:
+    session = _Session([200])
+    network = _Network(budget=0, session=session)
+
+    with pytest.raises(_NetworkUnavailableError):
+        network.get("https://pypi.org/pypi/test/json")
+    assert session.calls == 0
+
+
+def test_budget_starts_with_first_request(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = time.monotonic()
+    monkeypatch.setattr("time.monotonic", lambda: now)
+    session = _Session([200, 200])
+    network = _Network(budget=10, session=session)
+
+    now += 60
+    assert network.get("https://pypi.org/pypi/test/json").status_code == 200
+    now += 9
+    assert network.get("https://pypi.org/pypi/test/json").status_code == 200
+    now += 1
+    with pytest.raises(_NetworkUnavailableError):
+        network.get("https://pypi.org/pypi/test/json")
+    assert session.calls == 2
+
+
+def test_default_network_shared() -> None:
+    assert _DirectoryUpdate().run.network is _DirectoryUpdate().run.network
+
+
+def test_retry(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("time.sleep", lambda _: None)
+    session = _Session([503, 429, 200])
+    network = _Network(session=session)
+
+    assert network.get("https://pypi.org/pypi/test/json").status_code == 200
+    assert session.calls == 3
+    assert network.failures == 0
+
+
+def test_retry_exhausted(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("time.sleep", lambda _: None)
+    session = _Session([503, 503, 503, 200])
+    network = _Network(retries=2, session=session)
+
+    with pytest.raises(requests.HTTPError):
+        network.get("https://pypi.org/pypi/test/json")
+    assert session.calls == 3
+    assert network.failures == 1
@@ -0,0 +1,260 @@
+# Copyright (c) 2026, Stéphane Brunner
+
+"""
+Pytest suite for the in place patch of the configuration files.
+"""
+
+import subprocess
+from pathlib import Path
+from typing import Any
+
+import multi_repo_automation.editor
+import packaging.version
+import pytest
+
+import python_versions_hook
+from python_versions_hook import (
+    _edit_pyproject,
+    _patch_pyproject,
+    _pre_commit_assignments,
+    _Run,
+    _toml_value_spans,
+    _update_files_in_directory,
+    _yaml_value_spans,
+)
+
+_PYPROJECT = """# Header comment
+[tool.mypy]
+python_version = '3.8'  # keep this comment
+strict = true
+
+[tool.black]
+target-version = [
+    "py38",
+]
+
+[tool.ruff]
+target-version = "py38"
+
+[tool.poetry.dependencies]
+python = ">=3.9,<4"
+pkg = "1.2.3"
+
+[project]
+name = "test"
+classifiers = [
+    "Programming Language :: Python :: 3.8",
+    "Typing :: Typed",
+]
+requires-python = ">=3.8"
+dependencies = ["pkg==1.2.3"]
+
+[tool.tweak-poetry-dependencies-versions]
+default = "full"
+"""
+
+
+def test_toml_value_spans() -> None:
+    content = """a.b = 1
+[x]
+"q.k" = \"\"\"
+[fake]
+\"\"\"
+arr = [1, [2, 3], {a = 1}]  # comment
+[[t]]
+z = 1
+[y]
+w = 2024-01-01 10:00:00
+"""
+    spans = _toml_value_spans(content)
+    assert spans is not None
+    assert {path: content[span[0] : span[1]] for path, span in spans.items() if span is not None} == {
+        ("a", "b"): "1",
+        ("x", "q.k"): '"""\n[fake]\n"""',
+        ("x", "arr"): "[1, [2, 3], {a = 1}]",
+        ("y", "w"): "2024-01-01 10:00:00",
+    }
+
+
+def test_toml_value_spans_invalid() -> None:
+    assert _toml_value_spans('a = "unterminated\n') is None
+
+
+def test_patch_pyproject_same_as_editor(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    pyproject_path = tmp_path / "pyproject.toml"
+    pyproject_path.write_text(_PYPROJECT)
+    versions = (
+        packaging.version.Version("3.9"),
+        packaging.version.Version("3.0"),
+        packaging.version.Version("3.13"),
+    )
+
+    patch = _patch_pyproject(_PYPROJECT, *versions)
+    assert patch is not None
+    assert _edit_pyproject(pyproject_path, *versions)
+
+    assert patch == (pyproject_path.read_text(), True)
+    assert 'python_version = "3.9"  # keep this comment\n' in patch[0]
+
+
+def test_patch_pyproject_structure_change() -> None:
+    """The requires-python should be added, then the full editor is needed."""
+    content = _PYPROJECT.replace('requires-python = ">=3.8"\n', "")
+    assert (
+        _patch_pyproject(
+            content,
+            packaging.version.Version("3.9"),
+            packaging.version.Version("3.0"),
+            packaging.version.Version("3.13"),
+        )
+        is None
+    )
+
+
+def test_yaml_value_spans() -> None:
+    content = """default_language_version:
+  python: '3.8'
+repos:
+- repo: https://github.com/asottile/pyupgrade
+  hooks:
+  - id: pyupgrade
+    args: [--py38-plus]
+    files: |
+      text: not a key
+ci:
+  skip: [pyupgrade]
+"""
+    spans = _yaml_value_spans(content)
+    assert spans is not None
+    assert {path: content[span[0] : span[1]] for path, span in spans.items() if span is not None} == {
+        ("default_language_version", "python"): "'3.8'",
+        ("repos", 0, "repo"): "https://github.com/asottile/pyupgrade",
+        ("repos", 0, "hooks", 0, "id"): "pyupgrade",
+        ("repos", 0, "hooks", 0, "args"): "[--py38-plus]",
+        ("ci", "skip"): "[pyupgrade]",
+    }
+    assert ("repos", 0, "hooks", 0, "files") in spans
+
+
+def test_update_files_in_directory_yaml(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    pre_commit_config = """# Comment
+default_language_version:
+    python: "3.8" # comment
+repos:
+  - repo: https://github.com/asottile/pyupgrade
+    rev: v3.1.0
+    hooks:
+      - id: pyupgrade
+        args:
+          - --py38-plus
+"""
+    prospector = """mypy:
+  options:
+    python-version: '3.8'
+ruff:
+  options:
+    target-version: py38
+"""
+    (tmp_path / ".pre-commit-config.yaml").write_text(pre_commit_config)
+    (tmp_path / ".prospector.yaml").write_text(prospector)
+
+    _update_files_in_directory(
+        Path(),
+        packaging.version.Version("3.10"),
+        packaging.version.Version("3.0"),
+        packaging.version.Version("3.13"),
+        _Run(run_pre_commit=False),
+    )
+
+    assert (tmp_path / ".pre-commit-config.yaml").read_text() == pre_commit_config.replace(
+        '"3.8"',
+        "'3.10'",
+    ).replace("--py38-plus", "--py310-plus")
+    assert (tmp_path / ".prospector.yaml").read_text() == prospector.replace("'3.8'", "'3.10'").replace(
+        "py38",
+        "py310",
+    )
+
+
+@pytest.mark.parametrize(
+    ("files", "patched"),
+    [
+        ("^src/", True),
+        ("'^(src|tests)/'", True),
+        ("(?x)^(src|tests)/", False),
+        ("'  (?x)^(src|tests)/'", False),
+        ("^(" + "|".join(f"directory{index}" for index in range(10)) + ")/", False),
+        ("|\n          ^src/", False),
+    ],
+)
+def test_pre_commit_assignments_files(files: str, patched: bool) -> None:
+    """The regex that are rewritten by the pre-commit editor need the full editor."""
+    content = f"""repos:
+  - repo: https://github.com/asottile/pyupgrade
+    hooks:
+      - id: pyupgrade
+        args:
+          - --py38-plus
+        files: {files}
+"""
+    spans = _yaml_value_spans(content)
+    assert spans is not None
+    assignments = _pre_commit_assignments(content, spans, packaging.version.Version("3.10"))
+    assert (assignments is not None) == patched
+
+
+def _update_with_pre_commit(
+    root: Path, monkeypatch: pytest.MonkeyPatch, *, patch: bool
+) -> tuple[dict[str, str], list[list[str]]]:
+    """Update the test repository with the formatting pass, and get the files and the run commands."""
+    root.mkdir()
+    monkeypatch.chdir(root)
+    (root / ".pre-commit-config.yaml").write_text("""repos:
+  - repo: https://github.com/asottile/pyupgrade
+    rev: v3.1.0
+    hooks:
+      - id: pyupgrade
+        args:
+          - --py38-plus
+""")
+    (root / "pyproject.toml").write_text(_PYPROJECT)
+    (root / ".prospector.yaml").write_text("mypy:\n  options:\n    python-version: '3.8'\n")
+
+    commands = []
+
+    def run(cmd: list[str], **kwargs: Any) -> Any:
+        del kwargs
+        commands.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0)
+
+    monkeypatch.setattr(multi_repo_automation.editor, "run", run)
+    monkeypatch.setattr(python_versions_hook.mra, "run", run)
+    if not patch:
+        monkeypatch.setattr(python_versions_hook, "_patch_pyproject", lambda *args: None)
+        monkeypatch.setattr(python_versions_hook, "_patch_yaml_file", lambda *args: False)
+
+    _update_files_in_directory(
+        Path(),
+        packaging.version.Version("3.10"),
+        packaging.version.Version("3.0"),
+        packaging.version.Version("3.13"),
+    )
+    return {path.name: path.read_text() for path in sorted(root.iterdir())}, commands
+
+
+def test_update_files_in_directory_pre_commit(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """The patched files are formatted like with the full editors."""
+    with monkeypatch.context() as reference_monkeypatch:
+        reference_files, reference_commands = _update_with_pre_commit(
+            tmp_path / "reference", reference_monkeypatch, patch=False
+        )
+    files, commands = _update_with_pre_commit(tmp_path / "patch", monkeypatch, patch=True)
+
+    assert "mirrors-prettier" in files[".pre-commit-config.yaml"]
+    assert "--py310-plus" in files[".pre-commit-config.yaml"]
+    assert sorted(commands) == sorted(reference_commands)
+    assert [command for command in commands if "--files=.prospector.yaml" in command]
+    assert files[".prospector.yaml"] == reference_files[".prospector.yaml"]
+    assert files["pyproject.toml"] == reference_files["pyproject.toml"]
@@ -0,0 +1,181 @@
+# Copyright (c) 2026, Stéphane Brunner
+
+"""
+Pytest suite for the sharded execution, with many processes on the same repository.
+"""
+
+import concurrent.futures
+import json
+import multiprocessing
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import pytest
+import requests
+
+import python_versions_hook
+from python_versions_hook import _get_shared_releases, _lock_files, _Network, sync_python_versions
+
+
+class _Session(requests.Session):
+    def __init__(self, releases: list[str]) -> None:
+        super().__init__()
+        self.releases = releases
+        self.calls = 0
+
+    def get(self, url, **kwargs):  # type: ignore[override]
+        self.calls += 1
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({"releases": {release: [] for release in self.releases}}).encode()
+        return response
+
+
+def _get_releases_calls(cache_directory: Path) -> int:
+    session = _Session(["1.0.0", "1.1.0"])
+    assert _get_shared_releases("pkg", _Network(session=session), cache_directory) == ["1.0.0", "1.1.0"]
+    return session.calls
+
+
+def _fork_executor() -> concurrent.futures.ProcessPoolExecutor:
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context("fork")
+    )
+
+
+def test_lock_files_reentrant(tmp_path: Path) -> None:
+    path = tmp_path / "pyproject.toml"
+    path.touch()
+
+    def lock() -> None:
+        with _lock_files([path]), _lock_files([], [path]), _lock_files([path]):
+            pass
+
+    thread = threading.Thread(target=lock, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+
+
+def test_lock_files_exclusive(tmp_path: Path) -> None:
+    path = tmp_path / "pyproject.toml"
+    path.touch()
+    locked = threading.Event()
+
+    def lock() -> None:
+        with _lock_files([], [path]):
+            locked.set()
+
+    with _lock_files([path]):
+        thread = threading.Thread(target=lock, daemon=True)
+        thread.start()
+        assert not locked.wait(0.2)
+    assert locked.wait(10)
+    thread.join(timeout=10)
+
+
+def test_get_shared_releases(tmp_path: Path) -> None:
+    # Fetched by the first process, then got from the cache by the other ones
+    with _fork_executor() as executor:
+        assert executor.submit(_get_releases_calls, tmp_path).result() == 1
+        assert executor.submit(_get_releases_calls, tmp_path).result() == 0
+    assert _get_releases_calls(tmp_path) == 0
+
+    # Expired
+    cache = json.loads((tmp_path / "pkg.json").read_text())
+    (tmp_path / "pkg.json").write_text(json.dumps({**cache, "time": time.time() - 7200}))
+    assert _get_releases_calls(tmp_path) == 1
+    assert _get_releases_calls(tmp_path) == 0
+
+
+@pytest.mark.parametrize("content", ["", "{}", "[]", '{"time": "now", "releases": []}', '{"time": 0}'])
+def test_get_shared_releases_invalid(tmp_path: Path, content: str) -> None:
+    (tmp_path / "pkg.json").write_text(content)
+    assert _get_releases_calls(tmp_path) == 1
+    assert _get_releases_calls(tmp_path) == 0
+
+
+@pytest.fixture
+def repository(tmp_path: Path) -> Path:
+    root = tmp_path / "repository"
+    root.mkdir()
+    (root / "pyproject.toml").write_text('[project]\nrequires-python = ">=3.11"\n')
+    for name in ("a", "b", "c"):
+        (root / name / "src").mkdir(parents=True)
+        (root / name / "pyproject.toml").write_text('[tool.ruff]\ntarget-version = "py39"\n')
+        (root / name / "src" / ".python-version").write_text("3.9\n")
+    (root / "b" / "pyproject.toml").write_text(
+        '[project]\nrequires-python = ">=3.12"\n\n[tool.ruff]\ntarget-version = "py39"\n'
+    )
+    return root
+
+
+def _files(root: Path) -> dict[str, str]:
+    return {
+        str(path.relative_to(root)): path.read_text() for path in sorted(root.rglob("*")) if path.is_file()
+    }
+
+
+def test_sync_python_versions_files(repository: Path) -> None:
+    report = sync_python_versions(repository, files=["b/pyproject.toml"])
+
+    assert [directory.directory for directory in report.directories] == [
+        repository / "b",
+        repository / "b" / "src",
+    ]
+    assert 'target-version = "py39"' in (repository / "a" / "pyproject.toml").read_text()
+    assert 'target-version = "py312"' in (repository / "b" / "pyproject.toml").read_text()
+
+
+def _sync(root: Path, files: list[str]) -> list[str]:
+    report = sync_python_versions(root, files=files, jobs=2)
+    return [str(path.relative_to(root)) for path in report.changed_files]
+
+
+def test_sync_python_versions_shards(repository: Path, tmp_path: Path) -> None:
+    reference = tmp_path / "reference"
+    shutil.copytree(repository, reference)
+    sync_python_versions(reference)
+
+    # The shards overlap on the subdirectories that inherit the version of the root pyproject.toml
+    with _fork_executor() as executor:
+        futures = [
+            executor.submit(_sync, repository, ["pyproject.toml"]),
+            executor.submit(_sync, repository, ["a/pyproject.toml", "b/pyproject.toml", "c/pyproject.toml"]),
+        ]
+        changed_files = [future.result() for future in futures]
+
+    assert _files(repository) == _files(reference)
+    assert "b/pyproject.toml" in changed_files[0] + changed_files[1]
+    assert sync_python_versions(repository).changed_files == []
+
+
+def test_sync_python_versions_stale_parent(repository: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # The version of the parent can't change during the update of a subdirectory
+    update_pyproject = python_versions_hook._update_pyproject
+    updating = threading.Event()
+    written = threading.Event()
+    written_during_update = []
+
+    def slow_update_pyproject(*args, **kwargs):
+        updating.set()
+        written_during_update.append(written.wait(0.2))
+        return update_pyproject(*args, **kwargs)
+
+    monkeypatch.setattr(python_versions_hook, "_update_pyproject", slow_update_pyproject)
+
+    def write_parent() -> None:
+        updating.wait(10)
+        with _lock_files([repository / "pyproject.toml"]):
+            (repository / "pyproject.toml").write_text('[project]\nrequires-python = ">=3.13"\n')
+        written.set()
+
+    thread = threading.Thread(target=write_parent, daemon=True)
+    thread.start()
+    sync_python_versions(repository, files=["a/pyproject.toml"])
+    assert written.wait(10)
+
+    assert written_during_update == [False]
+    assert 'target-version = "py311"' in (repository / "a" / "pyproject.toml").read_text()
@@ -0,0 +1,140 @@
+# Copyright (c) 2026, Stéphane Brunner
+
+"""
+Pytest suite for the supported versions computed from the version intervals.
+"""
+
+from pathlib import Path
+
+import packaging.specifiers
+import packaging.version
+import pytest
+
+import python_versions_hook
+from python_versions_hook import (
+    _get_classifiers,
+    _get_directory_report,
+    _get_supported_versions,
+    _get_version_intervals,
+    _VersionInterval,
+)
+
+_V = packaging.version.Version
+
+
+@pytest.mark.parametrize(
+    "specifiers",
+    [
+        ">=3.8",
+        ">=3.8,<4",
+        ">=3.8,<4.0",
+        ">3.8",
+        ">3.8.1",
+        ">=3.8.1",
+        ">=3.10.0rc1",
+        "<3.10rc1",
+        "<=3.10",
+        "<=3.10.2",
+        "<3.10",
+        "==3.10",
+        "==3.10.0",
+        "==3.10.1",
+        "==3.10.*",
+        "!=3.10.*,>=3.8",
+        "!=3.10,>=3.8",
+        "!=3.10.1,>=3.8",
+        "~=3.10",
+        "~=3.10.1",
+        "==3.*",
+        "===3.10",
+        "===foobar",
+        ">=3.12,<3.11",
+        ">=3.8,!=3.9.*,!=3.11.*,<3.14",
+        "",
+    ],
+)
+def test_get_supported_versions(specifiers: str) -> None:
+    version_set = packaging.specifiers.SpecifierSet(specifiers)
+    expected = [_V(f"3.{minor}") for minor in range(15) if version_set.contains(_V(f"3.{minor}"))]
+
+    assert _get_supported_versions(version_set, _V("3.0"), _V("3.14")) == expected
+
+
+@pytest.mark.parametrize(
+    ("specifiers", "expected"),
+    [
+        (">=3.8,<4", [_VersionInterval(_V("3.8"), True, _V("4"), False)]),
+        ("^3.10", [_VersionInterval(_V("3.10"), True, _V("4.0"), False)]),
+        (
+            ">=3.8,!=3.10",
+            [
+                _VersionInterval(_V("3.8"), True, _V("3.10"), False),
+                _VersionInterval(_V("3.10"), False, None, False),
+            ],
+        ),
+        ("!=3.10.*,==3.10.*", []),
+        (">3.8,>=3.9,<=3.12,<3.13", [_VersionInterval(_V("3.9"), True, _V("3.12"), True)]),
+    ],
+)
+def test_get_version_intervals(specifiers: str, expected: list[_VersionInterval]) -> None:
+    assert _get_version_intervals(specifiers) == expected
+
+
+def test_get_supported_versions_poetry() -> None:
+    assert _get_supported_versions(
+        packaging.specifiers.SpecifierSet(">=3.12,<4.0"), _V("3.0"), _V("3.14")
+    ) == [_V("3.12"), _V("3.13"), _V("3.14")]
+
+
+@pytest.mark.parametrize(
+    ("specifiers", "expected"),
+    [
+        (">=3.12", ["3.12", "3.13", "3.14", "4.0", "4.1", "4.2"]),
+        (">=3.12,<4", ["3.12", "3.13", "3.14"]),
+        (">=3.13,!=4.0.*", ["3.13", "3.14", "4.1", "4.2"]),
+        (">=4.1", ["4.1", "4.2"]),
+        ("~=3.14", ["3.14"]),
+        ("~=3.14.0", ["3.14"]),
+        ("==4.*", ["4.0", "4.1", "4.2"]),
+    ],
+)
+def test_get_supported_versions_across_majors(
+    specifiers: str, expected: list[str], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(python_versions_hook, "_LAST_MINOR_VERSIONS", {2: 7, 3: 14})
+
+    assert _get_supported_versions(packaging.specifiers.SpecifierSet(specifiers), _V("3.0"), _V("4.2")) == [
+        _V(version) for version in expected
+    ]
+
+
+def test_get_classifiers_across_majors(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(python_versions_hook, "_LAST_MINOR_VERSIONS", {2: 7, 3: 14})
+
+    assert list(
+        _get_classifiers(
+            ["Typing :: Typed", "Programming Language :: Python :: 3.8"],
+            packaging.specifiers.SpecifierSet(">=3.14"),
+            _V("3.0"),
+            _V("4.0"),
+        )
+    ) == [
+        "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.14",
+        "Programming Language :: Python :: 4",
+        "Programming Language :: Python :: 4.0",
+        "Typing :: Typed",
+    ]
+
+
+def test_get_directory_report_across_majors(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(python_versions_hook, "_LAST_MINOR_VERSIONS", {2: 7, 3: 14})
+    (tmp_path / "pyproject.toml").write_text('[project]\nrequires-python = ">=3.13"\n')
+    (tmp_path / ".python-version").write_text("4.0\n")
+
+    report = _get_directory_report(tmp_path)
+
+    assert report is not None
+    assert report.minimal_version == _V("3.13")
+    assert report.supported_versions == [_V("3.13"), _V("3.14"), _V("4.0")]
@@ -0,0 +1,64 @@
+# Copyright (c) 2026, Stéphane Brunner
+
+"""
+Pytest suite for the library API.
+"""
+
+from pathlib import Path
+
+import packaging.specifiers
+import packaging.version
+import pytest
+
+from python_versions_hook import sync_python_versions
+
+
+@pytest.fixture
+def repository(tmp_path: Path) -> Path:
+    root = tmp_path / "repository"
+    (root / "project" / "src").mkdir(parents=True)
+    (root / "project" / "pyproject.toml").write_text("""[project]
+requires-python = ">=3.11"
+
+[tool.ruff]
+target-version = "py39"
+""")
+    (root / "project" / "src" / ".python-version").write_text("3.12.1\n")
+    (root / "other").mkdir()
+    # Outside the repository, should be ignored
+    (tmp_path / "pyproject.toml").write_text('[project]\nrequires-python = ">=3.9"\n')
+    return root
+
+
+def test_sync_python_versions_check(repository: Path) -> None:
+    report = sync_python_versions(repository, check=True)
+
+    assert [directory.directory for directory in report.directories] == [
+        repository / "project",
+        repository / "project" / "src",
+    ]
+    project = report.directories[0]
+    assert project.version == packaging.specifiers.SpecifierSet(">=3.11")
+    assert project.minimal_version == packaging.version.Version("3.11")
+    assert project.supported_versions[0] == packaging.version.Version("3.11")
+    assert project.changed_files == [repository / "project" / "pyproject.toml"]
+    assert report.directories[1].minimal_version == packaging.version.Version("3.12.1")
+    assert report.changed_files == [
+        repository / "project" / "pyproject.toml",
+        repository / "project" / "src" / ".python-version",
+    ]
+
+    # Nothing written in check mode
+    assert 'target-version = "py39"' in (repository / "project" / "pyproject.toml").read_text()
+    assert (repository / "project" / "src" / ".python-version").read_text() == "3.12.1\n"
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_sync_python_versions(repository: Path, jobs: int) -> None:
+    report = sync_python_versions(repository, jobs=jobs)
+
+    assert len(report.changed_files) == 2
+    assert 'target-version = "py311"' in (repository / "project" / "pyproject.toml").read_text()
+    assert (repository / "project" / "src" / ".python-version").read_text() == "3.12\n"
+
+    assert sync_python_versions(repository, jobs=jobs).changed_files == []
@@ -5,7 +5,7 @@ from pathlib import Path
 
 import multi_repo_automation as mra
 
-from python_versions_hook import _tweak_dependency_version
+from python_versions_hook import _get_tweaked_dependencies, _tweak_dependency_version
 
 
 def test_tweak_dependency_version_add() -> None:
@@ -340,3 +340,33 @@ test_pkg = "major"
             # Python should be skipped, test_pkg should be processed
             assert "python" not in str(edit["project"]["dependencies"])
             assert "test_pkg<3,>=2" in edit["project"]["dependencies"]
+
+
+def test_get_tweaked_dependencies_shared_extras() -> None:
+    """Test that an extra shared by several dependencies is computed once."""
+    pyproject = {
+        "project": {
+            "dependencies": ["pkg_main==0.1", "other>=1"],
+            "optional-dependencies": {"all": ["pkg_a==0.1"], "unused": ["pkg_c"]},
+        },
+        "tool": {
+            "poetry": {
+                "dependencies": {
+                    "python": "^3.10",
+                    "pkg_main": "1.0.0",
+                    "pkg_a": {"version": "1.2.3", "optional": True},
+                    "pkg_b": {"version": "2.3.4", "optional": True},
+                    "pkg_c": {"version": "3.4.5", "optional": True},
+                },
+                "extras": {"a": ["pkg_a"], "all": ["pkg_a", "pkg_b", "pkg_c"], "bc": ["pkg_b", "pkg_c"]},
+            },
+            "tweak-poetry-dependencies-versions": {"default": "major"},
+        },
+    }
+
+    assert _get_tweaked_dependencies(pyproject) == {
+        None: ["pkg_main<2,>=1", "other>=1"],
+        "a": ["pkg_a<2,>=1"],
+        "all": ["pkg_a<2,>=1", "pkg_b<3,>=2", "pkg_c<4,>=3"],
+        "bc": ["pkg_b<3,>=2", "pkg_c<4,>=3"],
+    }